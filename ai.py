@@ -1,15 +1,24 @@
 import math
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
 import numpy
 import tensorflow as tf
+from concurrent.futures import Future
 from game import *
 from typing import List
-import copy
 
 
 # I'm using some code from the original pseudocode AlphaZero here
 class AlphaZeroConfig(object):
     def __init__(self):
-        self.num_actors = 5000
+        # Self-play processes, which run alongside the one that trains. Network checkpoints and self-play games are
+        # shared through files under storage_directory
+        self.num_actors = max(1, os.cpu_count() - 1)
+        self.storage_directory = "alphazero"
 
         self.num_sampling_moves = 30
         self.max_moves = 512
@@ -17,13 +26,22 @@ class AlphaZeroConfig(object):
         # Root prior exploration noise.
         self.root_dirichlet_alpha = 0.3
         self.root_exploration_fraction = 0.25
+        # Inference. Self-play searches this many games at once in threads, and their leaf positions are evaluated
+        # together in batches of up to inference_batch_size, waiting at most inference_wait_us for a batch to fill
+        self.num_search_threads = 8
+        self.inference_batch_size = 64
+        self.inference_wait_us = 500
         # UCB formula
         self.pb_c_base = 19652
         self.pb_c_init = 1.25
         # Training
         self.training_steps = int(700e3)
         self.checkpoint_interval = int(1e3)
+        # positions kept in the replay buffer, and how many of the most visited actions each keeps as its policy
         self.window_size = int(1e6)
+        self.policy_entries = 64
+        # positions per segment file of a DiskReplayBuffer
+        self.segment_records = 1 << 16
         self.batch_size = 4096
         self.weight_decay = 1e-4
         self.momentum = 0.9
@@ -37,15 +55,25 @@ class AlphaZeroConfig(object):
 
 class Node(object):
 
-    def __init__(self, prior: float):
+    def __init__(self, prior: float, parent=None, index=None):
         self.visit_count = 0
         self.to_play = -1
         self.prior = prior
         self.value_sum = 0
-        self.children = {}
+        # this node is child number index of parent
+        self.parent = parent
+        self.index = index
+        # Filled in when the node is expanded. The statistics of the children are kept here in arrays, one entry per
+        # action, so that select_child scores them all in one NumPy expression. A child's Node is only made once it is
+        # selected
+        self.actions = []
+        self.priors = None
+        self.child_visits = None
+        self.child_value_sums = None
+        self.child_nodes = None
 
     def expanded(self):
-        return len(self.children) > 0
+        return len(self.actions) > 0
 
     def value(self):
         if self.visit_count == 0:
@@ -53,80 +81,451 @@ class Node(object):
         return self.value_sum / self.visit_count
 
 
+_PIECE_TYPES = numpy.arange(1, 8)[None, :, None]
+_RESEARCH_BITS = numpy.arange(1, 8)
+_IS_CITY = numpy.array([city is not None for row in Game().get_cities() for city in row])
+
+
+# The Game.encode planes for a batch of positions given as raw canonical states (see Game.get_canonical_state):
+# boards is (N, 384) int8 in the layout of Game._board, economy is (N,) bool, and money and research are (N, 2) with
+# the player to move first. Writes into out, shaped (N, ENCODING_PLANES, 64)
+def encode_batch(boards, economy, money, research, out):
+    pieces = boards[:, None, 0:64]
+    out[:, 0:7] = pieces == _PIECE_TYPES
+    out[:, 7:14] = pieces == -_PIECE_TYPES
+    out[:, 14:18] = boards[:, 64:320].reshape(-1, 4, 64)
+    cities = boards[:, 320:384]
+    out[:, 18] = cities == 1
+    out[:, 19] = cities == -1
+    out[:, 20] = (cities == 0) & _IS_CITY
+    out[:, 21] = economy[:, None]
+    out[:, 22:24] = money[:, :, None] / 10
+    out[:, 24:31] = (research[:, 0, None] >> _RESEARCH_BITS & 1)[:, :, None]
+    out[:, 31:38] = (research[:, 1, None] >> _RESEARCH_BITS & 1)[:, :, None]
+
+
+# Self-play data is stored as one fixed width record per position: its raw canonical state (see
+# Game.get_canonical_state), the id of the action that was played, the result for the player to move between 0 and 1,
+# and the policy_entries most visited actions with their share of the visits. Actions are in the canonical orientation
+def replay_record_dtype(policy_entries):
+    return numpy.dtype([
+        ("board", numpy.int8, 384),
+        ("economy", numpy.bool_),
+        ("money", numpy.int32, 2),
+        ("research", numpy.int32, 2),
+        ("action", numpy.int16),
+        ("value", numpy.float32),
+        ("policy_ids", numpy.int16, policy_entries),
+        ("policy_probs", numpy.float32, policy_entries),
+    ])
+
+
+# The records for every position of a finished self-play game that has search statistics, from one replay of it
+def game_records(game: Game, policy_entries):
+    records = numpy.zeros(game.history, replay_record_dtype(policy_entries))
+    policy = numpy.empty(Game.Action.NUM_IDS, numpy.float32)
+    history = game.get_history()
+    for state_index, position in zip(range(game.history), game.replay()):
+        board, (economy, own_money, opponent_money, own_research, opponent_research) = position.get_canonical_state()
+        records["board"][state_index] = numpy.frombuffer(board, numpy.int8)
+        records["economy"][state_index] = economy
+        records["money"][state_index] = own_money, opponent_money
+        records["research"][state_index] = own_research, opponent_research
+
+        action = history[state_index]
+        if position.get_player_to_move() == -1:
+            action = action.mirror()
+        records["action"][state_index] = action.to_id()
+
+        records["value"][state_index], _ = game.make_target(state_index, policy)
+        action_ids = numpy.flatnonzero(policy)
+        if len(action_ids) > policy_entries:
+            action_ids = action_ids[numpy.argpartition(policy[action_ids], -policy_entries)[-policy_entries:]]
+        probs = policy[action_ids]
+        records["policy_ids"][state_index, :len(action_ids)] = action_ids
+        records["policy_probs"][state_index, :len(action_ids)] = probs / probs.sum()
+    return records
+
+
+# Turns records into a training batch of images, target values and target policies
+def batch_from_records(records):
+    images = numpy.empty((len(records), Game.ENCODING_PLANES, 64), numpy.float32)
+    encode_batch(records["board"], records["economy"], records["money"], records["research"], images)
+    policies = numpy.zeros((len(records), Game.Action.NUM_IDS), numpy.float32)
+    # unused entries are action 0 with probability 0, so adding them changes nothing
+    numpy.add.at(policies, (numpy.arange(len(records))[:, None], records["policy_ids"]), records["policy_probs"])
+    return images, records["value"], policies
+
+
+# The records of the most recent positions, up to config.window_size of them, in a preallocated array used as a ring:
+# a new position overwrites the oldest one, and sampling is a random index per row, so neither depends on how full
+# the buffer is
 class ReplayBuffer(object):
 
     def __init__(self, config: AlphaZeroConfig):
         self.window_size = config.window_size
         self.batch_size = config.batch_size
-        self.buffer = []
+        self.policy_entries = config.policy_entries
+        self.records = numpy.zeros(self.window_size, replay_record_dtype(self.policy_entries))
+        self.next_index = 0
+        self.size = 0
 
-    def save_game(self, gametosave):
-        if len(self.buffer) > self.window_size:
-            self.buffer.pop(0)
-        self.buffer.append(gametosave)
+    def __len__(self):
+        return self.size
 
+    def save_game(self, gametosave: Game):
+        records = game_records(gametosave, self.policy_entries)[-self.window_size:]
+        self.records[(self.next_index + numpy.arange(len(records))) % self.window_size] = records
+        self.next_index = (self.next_index + len(records)) % self.window_size
+        self.size = min(self.size + len(records), self.window_size)
+
+    # Sampled uniformly across positions
     def sample_batch(self):
-        # Sample uniformly across positions.
-        move_sum = float(sum(g.history for g in self.buffer))
-        games = numpy.random.choice(
-            self.buffer,
-            size=self.batch_size,
-            p=[g.history / move_sum for g in self.buffer])
-        game_pos = [(g, numpy.random.randint(g.history)) for g in games]
-        return [(g.make_image(i), g.make_target(i)) for (g, i) in game_pos]
+        if self.size == 0:
+            raise Exception("Replay buffer is empty")
+        return batch_from_records(self.records[numpy.random.randint(self.size, size=self.batch_size)])
+
+    # The ring never holds more than the window, so there is nothing to delete
+    def prune(self):
+        pass
+
+
+# The same as ReplayBuffer, but the records live in segment files in a directory, so the window can be bigger than
+# memory and any number of processes can share it. Each DiskReplayBuffer that saves games appends to segment files of
+# its own, starting a new one every config.segment_records positions, so writers never need to coordinate. sample_batch
+# samples the newest window_size positions across all of them, taking the segments in the order they were last written
+# to, so a slow writer's newest records count as new however long ago its segment was started. Segments are read
+# through numpy.memmap so only the sampled records are read, and a record still being written is ignored until it is
+# complete. prune() deletes the segments that have fallen out of the window
+class DiskReplayBuffer(object):
+    SUFFIX = ".replay"
+
+    def __init__(self, config: AlphaZeroConfig, directory):
+        self.directory = directory
+        self.window_size = config.window_size
+        self.batch_size = config.batch_size
+        self.policy_entries = config.policy_entries
+        self.segment_records = config.segment_records
+        self.dtype = replay_record_dtype(self.policy_entries)
+        os.makedirs(directory, exist_ok=True)
+
+        # writing, which the self-play threads of a process take turns at
+        self.writer_name = "%d-%d" % (os.getpid(), id(self))
+        self.segment_path = None
+        self.segment_size = 0
+        self.write_lock = threading.Lock()
+
+        # reading: the memmap of each segment, remapped when the segment grows
+        self.mapped = {}
+        self.segments = []
+        self.offsets = numpy.zeros(0, numpy.int64)
+
+    def save_game(self, gametosave: Game):
+        records = game_records(gametosave, self.policy_entries)
+        with self.write_lock:
+            while len(records):
+                if self.segment_path is None or self.segment_size == self.segment_records:
+                    name = "%020d-%s%s" % (time.time_ns(), self.writer_name, self.SUFFIX)
+                    self.segment_path = os.path.join(self.directory, name)
+                    self.segment_size = 0
+                count = min(len(records), self.segment_records - self.segment_size)
+                with open(self.segment_path, "ab") as segment:
+                    segment.write(records[:count].tobytes())
+                self.segment_size += count
+                records = records[count:]
+
+    # Every segment file as (last modified, name, path, records), oldest first
+    def _list_segments(self):
+        segments = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # pruned by another process
+            segments.append((stat.st_mtime_ns, entry.name, entry.path, stat.st_size // self.dtype.itemsize))
+        segments.sort()
+        return segments
+
+    # Maps the newest segments that hold the window, oldest first
+    def refresh(self, listed=None):
+        if listed is None:
+            listed = self._list_segments()
+        segments = []
+        mapped = {}
+        total = 0
+        for modified, name, path, size in reversed(listed):
+            if total >= self.window_size:
+                break
+            if size == 0:
+                continue
+            segment = self.mapped.get(path)
+            if segment is None or len(segment) != size:
+                segment = numpy.memmap(path, self.dtype, mode="r", shape=(size,))
+            mapped[path] = segment
+            segments.append(segment)
+            total += size
+        segments.reverse()
+        self.mapped = mapped
+        self.segments = segments
+        self.offsets = numpy.cumsum([len(segment) for segment in segments], dtype=numpy.int64)
+
+    def __len__(self):
+        self.refresh()
+        return int(min(self.offsets[-1], self.window_size)) if len(self.offsets) else 0
+
+    # Sampled uniformly across the newest window_size positions
+    def sample_batch(self):
+        size = len(self)
+        if size == 0:
+            raise Exception("Replay buffer is empty")
+        total = self.offsets[-1]
+        positions = numpy.random.randint(total - size, total, size=self.batch_size)
+        which = numpy.searchsorted(self.offsets, positions, side="right")
+        records = numpy.empty(self.batch_size, self.dtype)
+        for segment_index in numpy.unique(which):
+            rows = which == segment_index
+            start = self.offsets[segment_index] - len(self.segments[segment_index])
+            records[rows] = self.segments[segment_index][positions[rows] - start]
+        return batch_from_records(records)
+
+    # Deletes the segments that are entirely older than the window. A segment that isn't full may still be written to,
+    # so it is only deleted once nothing has written to it for stale_seconds, which means its writer has stopped
+    def prune(self, stale_seconds=60 * 60):
+        listed = self._list_segments()
+        self.refresh(listed)
+        stale = time.time_ns() - stale_seconds * 10 ** 9
+        for modified, name, path, size in listed:
+            if path in self.mapped or (size < self.segment_records and modified > stale):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# The network sees every position with the player to move as White (see Game.canonical), so with Black to move its
+# policy is over the mirror images of the real actions. This maps it back onto the game's own action ids
+_MIRROR_POLICY = numpy.array([Game.Action.from_id(i).mirror().to_id() for i in range(Game.Action.NUM_IDS)])
+
+
+def orient_policy(game: Game, policy_logits):
+    if game.get_player_to_move() == -1:
+        return policy_logits[_MIRROR_POLICY]
+    return policy_logits
 
 
 class Network(object):
-    # unfinished
+    # A small convolutional network from the Game.encode planes to a value between 0 and 1 for the player to move, and
+    # a policy logit for each action id. The output layers start at zero, so an untrained network has a uniform policy
+    # and values of 0.5
+    def __init__(self, filters=64, layers=4):
+        inputs = tf.keras.Input(shape=(Game.ENCODING_PLANES, 64))
+        x = tf.keras.layers.Permute((2, 1))(inputs)
+        x = tf.keras.layers.Reshape((8, 8, Game.ENCODING_PLANES))(x)
+        for _ in range(layers):
+            x = tf.keras.layers.Conv2D(filters, 3, padding="same", activation="relu")(x)
+
+        value = tf.keras.layers.Conv2D(1, 1, activation="relu")(x)
+        value = tf.keras.layers.Flatten()(value)
+        value = tf.keras.layers.Dense(64, activation="relu")(value)
+        value = tf.keras.layers.Dense(1, activation="sigmoid", kernel_initializer="zeros")(value)
+
+        policy = tf.keras.layers.Conv2D(2, 1, activation="relu")(x)
+        policy = tf.keras.layers.Flatten()(policy)
+        policy = tf.keras.layers.Dense(Game.Action.NUM_IDS, kernel_initializer="zeros")(policy)
+
+        self.model = tf.keras.Model(inputs, [value, policy])
+
+    # One forward pass for a batch of images shaped (N, ENCODING_PLANES, 64). Returns N values and an (N, NUM_IDS)
+    # array of policy logits
+    def inference_batch(self, images):
+        value, policy_logits = self.model(images, training=False)
+        return value.numpy()[:, 0], policy_logits.numpy()
+
     def inference(self, image):
-        return -1, {}  # Value, Policy
+        values, policy_logits = self.inference_batch(image[numpy.newaxis])
+        return values[0], policy_logits[0]  # Value, Policy
+
+    # The value and the policy logits, indexed by action id, of the position in game
+    def evaluate(self, game: Game):
+        image = numpy.empty((Game.ENCODING_PLANES, 64), numpy.float32)
+        game.encode(image)
+        value, policy_logits = self.inference(image)
+        return value, orient_policy(game, policy_logits)
 
     def get_weights(self):
         # Returns the weights of this network.
-        return []
+        return self.model.trainable_weights
+
+
+# Evaluates positions for many search threads at once. evaluate() blocks the calling thread until its position has
+# been through the network, and a background thread gathers the waiting positions into one forward pass as soon as it
+# has max_batch of them, or max_wait_us after the first one arrived. Positions are encoded straight into a
+# preallocated batch, which is safe because their threads are waiting and can't change them
+class BatchEvaluator(object):
+    def __init__(self, network: Network, max_batch=64, max_wait_us=500):
+        self.network = network
+        self.max_batch = max_batch
+        self.max_wait = max_wait_us / 1e6
+        self._images = numpy.zeros((max_batch, Game.ENCODING_PLANES, 64), numpy.float32)
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def evaluate(self, game: Game):
+        future = Future()
+        self._requests.put((game, future))
+        return future.result()
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # finish this batch first, then stop
+                    self._requests.put(None)
+                    break
+                batch.append(request)
+            self._evaluate_batch(batch)
+
+    def _evaluate_batch(self, batch):
+        try:
+            images = self._images[:len(batch)]
+            for image, (game, future) in zip(images, batch):
+                game.encode(image)
+            values, policy_logits = self.network.inference_batch(images)
+            for index, (game, future) in enumerate(batch):
+                future.set_result((values[index], orient_policy(game, policy_logits[index])))
+        except Exception as e:
+            for game, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+# Network checkpoints in a directory, one file of weights per training step, shared by every process that opens it.
+# A checkpoint is written to a temporary file and renamed into place, so readers never see half of one.
+# latest_network() returns this process's one Network, loading the newest checkpoint into it when a newer one appears,
+# one thread at a time. Its weights are replaced in place, so a forward pass that is running meanwhile may use some of
+# each checkpoint's
+class SharedStorage(object):
+    PREFIX = "network-"
+    SUFFIX = ".npz"
 
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._step = None
+        self._network = None
+        self._lock = threading.Lock()
 
-class SharedStorage(object):
-    def __init__(self):
-        self._networks = {}
+    def _path(self, step: int):
+        return os.path.join(self.directory, "%s%012d%s" % (self.PREFIX, step, self.SUFFIX))
+
+    def latest_step(self):
+        steps = [int(name[len(self.PREFIX):-len(self.SUFFIX)]) for name in os.listdir(self.directory)
+                 if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)]
+        return max(steps) if steps else None
 
     def latest_network(self) -> Network:
-        if self._networks:
-            return self._networks[max(iter(self._networks.keys()))]
-        else:
-            return Network()  # policy -> uniform, value -> 0.5
+        with self._lock:
+            if self._network is None:
+                self._network = Network()  # policy -> uniform, value -> 0.5
+            step = self.latest_step()
+            if step is not None and step != self._step:
+                with numpy.load(self._path(step)) as weights:
+                    self._network.model.set_weights([weights["arr_%d" % i] for i in range(len(weights.files))])
+                self._step = step
+            return self._network
 
     def save_network(self, step: int, network: Network):
-        self._networks[step] = network
+        path = self._path(step)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, "wb") as file:
+            numpy.savez(file, *network.model.get_weights())
+        os.replace(temporary, path)
 
 
-def alphazero(config: AlphaZeroConfig):
-    storage = SharedStorage()
-    replay_buffer = ReplayBuffer(config)
+def _storage(config: AlphaZeroConfig):
+    storage = SharedStorage(os.path.join(config.storage_directory, "networks"))
+    replay_buffer = DiskReplayBuffer(config, os.path.join(config.storage_directory, "replay"))
+    return storage, replay_buffer
+
 
-    for i in range(config.num_actors):
-        run_selfplay(config, storage, replay_buffer)
+# The entry point of a self-play process
+def _run_actor(config: AlphaZeroConfig, seed: int):
+    random.seed(seed)
+    numpy.random.seed(seed % 2 ** 32)
+    # the actors share the machine, so each does its inference on one core
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    storage, replay_buffer = _storage(config)
+    run_selfplay(config, storage, replay_buffer)
 
-    train_network(config, storage, replay_buffer)
+
+# Starts num_actors self-play processes and trains in this one until training_steps, then stops the actors. Everything
+# is kept in files, so stopping and calling this again carries on from the latest checkpoint
+def alphazero(config: AlphaZeroConfig):
+    storage, replay_buffer = _storage(config)
+
+    # tensorflow doesn't survive a fork, so the actors start from scratch
+    context = multiprocessing.get_context("spawn")
+    actors = [context.Process(target=_run_actor, args=(config, random.getrandbits(64)), daemon=True)
+              for _ in range(config.num_actors)]
+    for actor in actors:
+        actor.start()
+    try:
+        train_network(config, storage, replay_buffer)
+    finally:
+        for actor in actors:
+            actor.terminate()
+        for actor in actors:
+            actor.join()
 
     return storage.latest_network()
 
 
 def run_selfplay(config: AlphaZeroConfig, storage: SharedStorage,
                  replay_buffer: ReplayBuffer):
-    while True:
-        network = storage.latest_network()
-        game = play_game(config, network)
-        replay_buffer.save_game(game)
+    # the threads' searches share one evaluator, so their leaves go through the network together
+    evaluator = BatchEvaluator(storage.latest_network(), config.inference_batch_size, config.inference_wait_us)
+
+    def actor():
+        while True:
+            evaluator.network = storage.latest_network()
+            game = play_game(config, evaluator)
+            replay_buffer.save_game(game)
 
+    threads = [threading.Thread(target=actor, daemon=True) for _ in range(config.num_search_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
+
+# network can be a Network or a BatchEvaluator, anything with evaluate(game)
 def play_game(config: AlphaZeroConfig, network: Network):
-    # todo: alter the original store_search_statistics from here
     gametoplay = Game()
     while not gametoplay.is_terminal() and gametoplay.history < config.max_moves:
         action, root = run_mcts(config, gametoplay, network)
-        gametoplay.take_action(action)
         gametoplay.store_search_statistics(root)
+        gametoplay.take_action(action)
     return gametoplay
 
 
@@ -135,82 +534,117 @@ def run_mcts(config: AlphaZeroConfig, game: Game, network: Network):
     evaluate(root, game, network)
     add_exploration_noise(config, root)
 
+    # every simulation walks down from the root on this one board, then undoes its way back up
+    scratch_game = game.clone()
     for _ in range(config.num_simulations):
         node = root
-        scratch_game = copy.deepcopy(game)
         search_path = [node]
+        undo_records = []
 
         while node.expanded():
-            action, node = select_child(config, node)
-            scratch_game.take_action(action)
+            index, child = select_child(config, node)
+            undo_records.append(scratch_game.take_action(node.actions[index], record=True))
+            node = child
             search_path.append(node)
 
         value = evaluate(node, scratch_game, network)
-        backpropagate(search_path, value, (scratch_game.history % 2))
+        backpropagate(search_path, value, scratch_game.get_player_to_move())
+
+        for undo_record in reversed(undo_records):
+            scratch_game.undo(undo_record)
     return select_action(config, game, root), root
 
 
 def select_action(config: AlphaZeroConfig, game: Game, root: Node):
-    visit_counts = [(child.visit_count, action)
-                    for action, child in iter(root.children.items())]
+    visit_counts = root.child_visits
     if game.history < config.num_sampling_moves:
-        _, action = 0, 0
+        # early in the game, play in proportion to the visits for variety
+        index = numpy.random.choice(len(visit_counts), p=visit_counts / visit_counts.sum())
     else:
-        _, action = max(visit_counts)
-    return action
+        index = numpy.argmax(visit_counts)
+    return root.actions[index]
 
 
+# Returns the index of the child with the best PUCT score, and its Node
 def select_child(config: AlphaZeroConfig, node: Node):
-    _, action, child = max((ucb_score(config, node, child), action, child)
-                           for action, child in (node.children.items()))
-    return action, child
+    index = int(numpy.argmax(ucb_scores(config, node)))
+    child = node.child_nodes[index]
+    if child is None:
+        child = node.child_nodes[index] = Node(node.priors[index], node, index)
+    return index, child
 
 
-def ucb_score(config: AlphaZeroConfig, parent: Node, child: Node):
+# The PUCT score of every child of parent. The exploration factor only depends on the parent, so it is worked out once
+def ucb_scores(config: AlphaZeroConfig, parent: Node):
     pb_c = math.log((parent.visit_count + config.pb_c_base + 1) /
                     config.pb_c_base) + config.pb_c_init
-    pb_c *= math.sqrt(parent.visit_count) / (child.visit_count + 1)
+    pb_c *= math.sqrt(parent.visit_count)
 
-    prior_score = pb_c * child.prior
-    value_score = child.value()
-    return prior_score + value_score
+    visits = parent.child_visits
+    prior_scores = pb_c * parent.priors / (visits + 1)
+    # unvisited children have a value of 0
+    value_scores = parent.child_value_sums / numpy.maximum(visits, 1)
+    return prior_scores + value_scores
 
 
 def evaluate(node: Node, game: Game, network: Network):
-    # todo: alter from the old make_image
-    value, policy_logits = network.inference(game.make_image(-1))
+    node.to_play = game.get_player_to_move()
+    if game.is_terminal():
+        # the result is known, and the node is never expanded, so the simulations that reach it stop there
+        return (game.get_reward() * node.to_play + 1) / 2
+    value, policy_logits = network.evaluate(game)
 
     # Expand the node.
-    node.to_play = game.history % 2
-    policy = {a: math.exp(policy_logits[a]) for a in game.get_possible_actions()}
-    policy_sum = sum(iter(policy.values()))
-    for action, p in enumerate(policy.items()):
-        node.children[action] = Node(p / policy_sum)
+    actions = game.get_possible_actions()
+    # policy_logits is indexed by action id (see Game.Action.NUM_IDS)
+    logits = policy_logits[numpy.fromiter((a.to_id() for a in actions), numpy.int64, len(actions))]
+    policy = numpy.exp(logits - logits.max())
+    node.actions = actions
+    node.priors = policy / policy.sum()
+    node.child_visits = numpy.zeros(len(actions))
+    node.child_value_sums = numpy.zeros(len(actions))
+    node.child_nodes = [None] * len(actions)
     return value
 
 
+# value is for to_play, the player to move at the leaf. Each node's value_sum is kept for its own player to move, but
+# its entry in the parent's child_value_sums is for the parent's, since that is who chooses between the children. The
+# two differ after Research, End Turn and any other action that passes play to the other side
 def backpropagate(search_path: List[Node], value: float, to_play):
     for node in search_path:
         node.value_sum += value if node.to_play == to_play else (1 - value)
         node.visit_count += 1
+        if node.parent is not None:
+            node.parent.child_value_sums[node.index] += value if node.parent.to_play == to_play else (1 - value)
+            node.parent.child_visits[node.index] += 1
 
 
 def add_exploration_noise(config: AlphaZeroConfig, node: Node):
-    actions = node.children.keys()
-    noise = numpy.random.gamma(config.root_dirichlet_alpha, 1, len(actions))
+    noise = numpy.random.gamma(config.root_dirichlet_alpha, 1, len(node.actions))
     frac = config.root_exploration_fraction
-    for a, n in zip(actions, noise):
-        node.children[a].prior = node.children[a].prior * (1 - frac) + n * frac
+    node.priors = node.priors * (1 - frac) + noise * frac
 
 
+# Trains from the latest checkpoint in storage, if there is one, checkpointing every checkpoint_interval steps for the
+# actors to pick up and pruning the replay buffer at each checkpoint. Waits for the replay buffer to hold a batch first
 def train_network(config: AlphaZeroConfig, storage: SharedStorage,
                   replay_buffer: ReplayBuffer):
-    network = Network()
-    optimizer = tf.keras.optimizers.SGD(config.learning_rate_schedule,
-                                           config.momentum)
-    for i in range(config.training_steps):
-        if i % config.checkpoint_interval == 0:
+    start = storage.latest_step() or 0
+    network = storage.latest_network()
+    boundaries = sorted(config.learning_rate_schedule)
+    learning_rate = tf.keras.optimizers.schedules.PiecewiseConstantDecay(
+        [boundary - start for boundary in boundaries[1:]],
+        [config.learning_rate_schedule[boundary] for boundary in boundaries])
+    optimizer = tf.keras.optimizers.SGD(learning_rate, config.momentum)
+    if start == 0:
+        storage.save_network(0, network)
+    while len(replay_buffer) < config.batch_size:
+        time.sleep(1)
+
+    for i in range(start, config.training_steps):
+        if i % config.checkpoint_interval == 0 and i != start:
             storage.save_network(i, network)
+            replay_buffer.prune()
         batch = replay_buffer.sample_batch()
         update_weights(optimizer, network, batch, config.weight_decay)
     storage.save_network(config.training_steps, network)
@@ -218,15 +652,16 @@ def train_network(config: AlphaZeroConfig, storage: SharedStorage,
 
 def update_weights(optimizer: tf.compat.v1.train.Optimizer, network: Network, batch,
                    weight_decay: float):
-    loss = 0
-    for image, (target_value, target_policy) in batch:
-        value, policy_logits = network.inference(image)
-        loss += (
-                tf.keras.losses.mean_squared_error(value, target_value) +
-                tf.nn.softmax_cross_entropy_with_logits(
-                    logits=policy_logits, labels=target_policy))
-
-    for weights in network.get_weights():
-        loss += weight_decay * tf.nn.l2_loss(weights)
-
-    optimizer.minimize(loss)
+    images, target_values, target_policies = batch
+    with tf.GradientTape() as tape:
+        values, policy_logits = network.model(images, training=True)
+        loss = (
+                tf.reduce_mean(tf.square(target_values[:, None] - values)) +
+                tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(
+                    logits=policy_logits, labels=target_policies)))
+
+        for weights in network.get_weights():
+            loss += weight_decay * tf.nn.l2_loss(weights)
+
+    gradients = tape.gradient(loss, network.get_weights())
+    optimizer.apply_gradients(zip(gradients, network.get_weights()))
@@ -3,20 +3,54 @@ import time
 import math
 import random
 import game as g
-import copy
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 
 class AIAgent(Agent):
+    def __init__(self, timeLimit=1000, workers=1, compactTree=False, maxNodes=1000000, rolloutPolicy=None,
+                 turnSearch=False):
+        # randomPolicy unless the caller opts into another, e.g. cutoffPolicy()
+        if rolloutPolicy is None:
+            rolloutPolicy = randomPolicy
+        # With turnSearch, the tree plans whole turns, and the actions of the chosen turn are handed out one at a time
+        # for as long as the game follows the plan. Each entry is the hash of the position the action is for
+        self.plan = []
+        if turnSearch:
+            self.searcher = turnMcts(timeLimit=timeLimit, keepTree=True, rolloutPolicy=rolloutPolicy)
+        elif compactTree:
+            # A much smaller tree, for when many searches run at once, but it can't carry over between actions
+            self.searcher = arenaMcts(timeLimit=timeLimit, maxNodes=maxNodes, rolloutPolicy=rolloutPolicy)
+        else:
+            # One searcher for the whole game, so the part of the tree that is still reachable carries over from one
+            # action to the next
+            self.searcher = mcts(timeLimit=timeLimit, workers=workers, keepTree=True, rolloutPolicy=rolloutPolicy)
+
     def decide_action(self, gametosearch: g.Game):
-        actiontotake = mcts(timeLimit=1000).search(gametosearch, needDetails=True)
+        if isinstance(self.searcher, turnMcts):
+            if not self.plan or self.plan[0][0] != gametosearch.get_hash():
+                bundle = self.searcher.search(gametosearch, needDetails=True)
+                game = gametosearch.clone()
+                self.plan = []
+                for action in bundle:
+                    self.plan.append((game.get_hash(), action))
+                    game.take_action(action)
+            return self.plan.pop(0)[1]
+        actiontotake = self.searcher.search(gametosearch, needDetails=True)
         return actiontotake
 
+    # Drops the tree, table and plan kept for the next decision, for when the agent will sit idle for a while
+    def forget(self):
+        self.plan = []
+        self.searcher.forget()
+
 
 # Some of the following code taken from the MCTS.py package on PyPi
 
 
 def randomPolicy(game2):
-    game = copy.deepcopy(game2)
+    game = game2.clone()
     while not game.is_terminal():
         try:
             action = random.choice(game.get_possible_actions())
@@ -37,27 +71,141 @@ def randomPolicy(game2):
     return game.get_reward()
 
 
+# Scores a position from White's point of view between -1 and 1 without playing it out: the result if the game is
+# over, otherwise a squashed weighted difference of cities, material on the board, money and researched piece types
+def staticEvaluation(game):
+    if game.is_terminal():
+        return game.get_reward()
+    summary = game.get_summary()
+    score = (0.5 * (summary["white_cities"] - summary["black_cities"]) +
+             0.1 * (summary["white_material"] - summary["black_material"]) +
+             0.05 * (summary["white_money"] - summary["black_money"]) +
+             0.1 * (summary["white_researched"] - summary["black_researched"]))
+    return math.tanh(score)
+
+
+def randomAction(game, actions):
+    return random.choice(actions)
+
+
+# Captures whenever it can and usually attacks when it can, since a random player almost never finishes the game
+def heuristicAction(game, actions):
+    captures = []
+    attacks = []
+    for action in actions:
+        if action.action_type == g.Game.Action.TYPE_CAPTURE:
+            captures.append(action)
+        elif action.action_type == g.Game.Action.TYPE_ATTACK:
+            attacks.append(action)
+    if captures:
+        return random.choice(captures)
+    if attacks and random.random() < 0.75:
+        return random.choice(attacks)
+    return random.choice(actions)
+
+
+# A rollout policy that picks actions with chooseAction and stops after maxPlies, scoring the position it stopped on
+# with evaluate. maxPlies=None plays to the end like randomPolicy, and maxPlies=0 skips the rollout and just evaluates
+# the leaf, so evaluate can be any value function. It's a class rather than a closure so it can be sent to the workers
+# of a parallel search
+class cutoffPolicy:
+    def __init__(self, maxPlies=200, chooseAction=heuristicAction, evaluate=staticEvaluation):
+        self.maxPlies = maxPlies
+        self.chooseAction = chooseAction
+        self.evaluate = evaluate
+
+    def __call__(self, game2):
+        if self.maxPlies == 0 or game2.is_terminal():
+            return self.evaluate(game2)
+        game = game2.clone()
+        plies = 0
+        while not game.is_terminal() and plies != self.maxPlies:
+            game.take_action(self.chooseAction(game, game.get_possible_actions()))
+            plies += 1
+        return self.evaluate(game)
+
+
+class nodeStats:
+    __slots__ = ("numVisits", "totalReward")
+
+    def __init__(self):
+        self.numVisits = 0
+        self.totalReward = 0
+
+
+# Search statistics shared by every tree node that reaches the same position (by Game.get_hash()), so a position found
+# through a different order of actions starts with everything already learned about it. Holds at most maxSize positions
+# and forgets the least recently used ones first
+class transpositionTable:
+    def __init__(self, maxSize=200000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    def lookup(self, key):
+        stats = self.entries.get(key)
+        if stats is None:
+            stats = nodeStats()
+            self.entries[key] = stats
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return stats
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class treeNode:
-    def __init__(self, game, parent):
+    def __init__(self, game, parent, stats=None, key=None, sign=1):
         self.game = game
+        self.key = key
+        # stats are kept for the canonical orientation of the position (see Game.canonical), and sign turns them into
+        # this node's
+        self.sign = sign
         self.is_terminal = game.is_terminal()
         self.isFullyExpanded = self.is_terminal
         self.parent = parent
-        self.numVisits = 0
-        self.totalReward = 0
+        self.stats = stats if stats is not None else nodeStats()
         self.children = {}
 
     def __str__(self):
         s=[]
-        s.append("totalReward: %s"%(self.totalReward))
-        s.append("numVisits: %d"%(self.numVisits))
+        s.append("totalReward: %s"%(self.stats.totalReward))
+        s.append("numVisits: %d"%(self.stats.numVisits))
         s.append("is_terminal: %s"%(self.is_terminal))
         s.append("possibleActions: %s"%(self.children.keys()))
         return "%s: {%s}"%(self.__class__.__name__, ', '.join(s))
 
+    # The average reward from White's point of view
+    def meanReward(self):
+        return self.sign * self.stats.totalReward / self.stats.numVisits
+
+# Process pools for parallel searches, one per number of workers. They are kept for the life of the process so that
+# searches don't pay for starting processes every time
+_pools = {}
+
+
+def _getPool(workers):
+    if workers not in _pools:
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[workers]
+
+
+# Runs one independent search in a worker process, and returns how many rounds it ran and the statistics of the root's
+# children by action id
+def _rootSearch(game, searchOptions, seed):
+    random.seed(seed)
+    searcher = mcts(**searchOptions)
+    searcher.search(game)
+    childStats = {action.to_id(): (child.stats.numVisits, child.sign * child.stats.totalReward)
+                  for action, child in searcher.root.children.items()}
+    return searcher.rounds, childStats
+
+
 class mcts():
     def __init__(self, timeLimit=None, iterationLimit=None, explorationConstant=1 / math.sqrt(2),
-                 rolloutPolicy=randomPolicy):
+                 rolloutPolicy=randomPolicy, transpositionTable=None, workers=1, keepTree=False, foldSymmetry=False):
         if timeLimit != None:
             if iterationLimit is not None:
                 raise ValueError("Cannot have both a time limit and an iteration limit")
@@ -74,22 +222,108 @@ class mcts():
             self.limitType = 'iterations'
         self.explorationConstant = explorationConstant
         self.rollout = rolloutPolicy
+        # Pass in a table to share statistics between searches, otherwise every search starts with an empty one
+        self.sharedTable = transpositionTable
+        # With more than one worker, each worker process searches its own tree under the same limit (root
+        # parallelization) and their root statistics are added together. The rollout policy has to be picklable
+        self.workers = workers
+        # With keepTree, a search that starts from a position already in the previous search's tree (after any number
+        # of actions, by either player) keeps that subtree and its statistics instead of starting over
+        self.keepTree = keepTree
+        # With foldSymmetry, a position and its mirror image (see Game.mirror) share their statistics
+        self.foldSymmetry = foldSymmetry
+        self.root = None
+        self.table = None
+        self.rounds = 0
 
     def search(self, initialgame, needDetails=False):
-        self.root = treeNode(copy.deepcopy(initialgame), None)
+        if self.workers > 1:
+            return self.parallelSearch(initialgame, needDetails)
+
+        root = self.findSubtree(initialgame) if self.keepTree else None
+        if root is not None:
+            # cut the subtree loose so the rest of the old tree can be freed
+            root.parent = None
+            self.root = root
+        else:
+            self.table = self.sharedTable if self.sharedTable is not None else transpositionTable()
+            self.root = self.makeNode(initialgame.clone(), None)
+        self.rounds = 0
 
         if self.limitType == 'time':
             timeLimit = time.time() + self.timeLimit / 1000
             while time.time() < timeLimit:
                 self.executeRound()
+                self.rounds += 1
         else:
             for i in range(self.searchLimit):
                 self.executeRound()
+                self.rounds += 1
 
         bestChild = self.getBestChild(self.root, 0)
         action = (action for action, node in self.root.children.items() if node is bestChild).__next__()
         if needDetails:
-            print("action: ", str(action), "expectedReward:", str(bestChild.totalReward / bestChild.numVisits))
+            print("action: ", str(action), "expectedReward:", str(bestChild.meanReward()))
+        return action
+
+    # Lets go of the tree and table from the last search, which keepTree would otherwise hold on to until the next one
+    def forget(self):
+        self.root = None
+        self.table = None
+
+    # Finds the node for this game's position in the tree from the last search, or None if it isn't there
+    def findSubtree(self, game):
+        if self.root is None:
+            return None
+        key, sign = self.nodeKey(game)
+        frontier = [self.root]
+        while frontier:
+            nextFrontier = []
+            for node in frontier:
+                # the sign tells a position from its mirror image, which has the other player to move
+                if node.key == key and node.sign == sign:
+                    return node
+                nextFrontier.extend(node.children.values())
+            frontier = nextFrontier
+        return None
+
+    def parallelSearch(self, initialgame, needDetails=False):
+        searchOptions = {
+            'timeLimit': self.timeLimit if self.limitType == 'time' else None,
+            'iterationLimit': self.searchLimit if self.limitType == 'iterations' else None,
+            'explorationConstant': self.explorationConstant,
+            'rolloutPolicy': self.rollout,
+            'foldSymmetry': self.foldSymmetry,
+        }
+        pool = _getPool(self.workers)
+        futures = [pool.submit(_rootSearch, initialgame, searchOptions, random.getrandbits(64))
+                   for _ in range(self.workers)]
+
+        merged = {}
+        self.rounds = 0
+        for future in futures:
+            rounds, childStats = future.result()
+            self.rounds += rounds
+            for actionId, (numVisits, totalReward) in childStats.items():
+                stats = merged.setdefault(actionId, nodeStats())
+                stats.numVisits += numVisits
+                stats.totalReward += totalReward
+
+        # pick the same way getBestChild does with no exploration
+        player = initialgame.get_player_to_move()
+        bestValue = float("-inf")
+        bestActions = []
+        for actionId, stats in merged.items():
+            value = player * stats.totalReward / stats.numVisits
+            if value > bestValue:
+                bestValue = value
+                bestActions = [actionId]
+            elif value == bestValue:
+                bestActions.append(actionId)
+        actionId = random.choice(bestActions)
+        action = g.Game.Action.from_id(actionId)
+        if needDetails:
+            print("action: ", str(action), "expectedReward:", str(merged[actionId].totalReward / merged[actionId].numVisits))
         return action
 
     def executeRound(self):
@@ -110,29 +344,233 @@ class mcts():
         actions = node.game.get_possible_actions()
         for action in actions:
             if action not in node.children:
-                newNode = treeNode(copy.deepcopy(node.game), node)
-                newNode.game.take_action(action)
+                newGame = node.game.clone()
+                newGame.take_action(action)
+                newNode = self.makeNode(newGame, node)
                 node.children[action] = newNode
                 if len(actions) == len(node.children):
                     node.isFullyExpanded = True
                 return newNode
         raise Exception("Should never reach here")
 
+    def makeNode(self, game, parent):
+        key, sign = self.nodeKey(game)
+        return treeNode(game, parent, self.table.lookup(key), key, sign)
+
+    # The transposition table key of a position, and the sign of its stats. With foldSymmetry, a position and its
+    # mirror image share one entry
+    def nodeKey(self, game):
+        if self.foldSymmetry:
+            canonical, sign = game.canonical()
+            return canonical.get_hash(), sign
+        return game.get_hash(), 1
+
     def backpropagate(self, node, reward):
         while node is not None:
-            node.numVisits += 1
-            node.totalReward += reward
+            node.stats.numVisits += 1
+            node.stats.totalReward += node.sign * reward
             node = node.parent
 
     def getBestChild(self, node, explorationValue):
         bestValue = float("-inf")
         bestNodes = []
         for child in node.children.values():
-            nodeValue = node.game.get_player_to_move() * child.totalReward / child.numVisits + explorationValue * math.sqrt(
-                2 * math.log(node.numVisits) / child.numVisits)
+            nodeValue = node.game.get_player_to_move() * child.meanReward() + explorationValue * math.sqrt(
+                2 * math.log(node.stats.numVisits) / child.stats.numVisits)
+            if nodeValue > bestValue:
+                bestValue = nodeValue
+                bestNodes = [child]
+            elif nodeValue == bestValue:
+                bestNodes.append(child)
+        return random.choice(bestNodes)
+
+
+# The same search as mcts, but the tree is kept in a handful of flat arrays indexed by node number instead of treeNode
+# objects, and no node holds a game. Each round replays the actions from the root on one board and undoes them
+# afterwards, so a node only costs the bytes in bytesPerNode(). Once the tree has maxNodes nodes it stops growing, and
+# rounds that reach an unexpanded node roll out from there without adding to the tree
+class arenaMcts(mcts):
+    FULLY_EXPANDED = 1
+    TERMINAL = 2
+
+    def __init__(self, timeLimit=None, iterationLimit=None, explorationConstant=1 / math.sqrt(2),
+                 rolloutPolicy=randomPolicy, maxNodes=1000000):
+        super().__init__(timeLimit=timeLimit, iterationLimit=iterationLimit, explorationConstant=explorationConstant,
+                         rolloutPolicy=rolloutPolicy)
+        # the root and at least one child, or there is no action to choose
+        if maxNodes < 2:
+            raise ValueError("Node limit must be at least two")
+        self.maxNodes = maxNodes
+        self.clearTree()
+
+    def clearTree(self):
+        self.numVisits = array('q')
+        self.totalReward = array('d')
+        # children are a linked list: the first child of each node, and the next child of the same parent (-1 for none)
+        self.firstChild = array('i')
+        self.nextSibling = array('i')
+        # the id of the action that leads to each node from its parent
+        self.actionId = array('h')
+        # how many of the node's possible actions have a child so far. They are expanded in the order that
+        # get_possible_actions lists them, so the next one to expand is always at this index
+        self.numExpanded = array('H')
+        self.flags = array('b')
+
+    def forget(self):
+        super().forget()
+        self.clearTree()
+
+    @classmethod
+    def bytesPerNode(cls):
+        node = cls.__new__(cls)
+        node.clearTree()
+        return sum(column.itemsize for column in (node.numVisits, node.totalReward, node.firstChild, node.nextSibling,
+                                                  node.actionId, node.numExpanded, node.flags))
+
+    def numNodes(self):
+        return len(self.numVisits)
+
+    def addNode(self, parent, actionId, isTerminal):
+        node = len(self.numVisits)
+        self.numVisits.append(0)
+        self.totalReward.append(0)
+        self.firstChild.append(-1)
+        self.actionId.append(actionId)
+        self.numExpanded.append(0)
+        self.flags.append(self.TERMINAL | self.FULLY_EXPANDED if isTerminal else 0)
+        if parent == -1:
+            self.nextSibling.append(-1)
+        else:
+            self.nextSibling.append(self.firstChild[parent])
+            self.firstChild[parent] = node
+        return node
+
+    def search(self, initialgame, needDetails=False):
+        self.clearTree()
+        self.game = initialgame.clone()
+        self.addNode(-1, -1, self.game.is_terminal())
+        self.rounds = 0
+
+        if self.limitType == 'time':
+            timeLimit = time.time() + self.timeLimit / 1000
+            while time.time() < timeLimit:
+                self.executeRound()
+                self.rounds += 1
+        else:
+            for i in range(self.searchLimit):
+                self.executeRound()
+                self.rounds += 1
+
+        bestChild = self.getBestChild(0, self.game.get_player_to_move(), 0)
+        action = g.Game.Action.from_id(self.actionId[bestChild])
+        if needDetails:
+            print("action: ", str(action), "expectedReward:", str(self.totalReward[bestChild] / self.numVisits[bestChild]))
+        return action
+
+    def executeRound(self):
+        game = self.game
+        flags = self.flags
+        path = [0]
+        undoRecords = []
+
+        # selection and expansion, playing the actions on the way down
+        node = 0
+        while not flags[node] & self.TERMINAL:
+            if flags[node] & self.FULLY_EXPANDED:
+                node = self.getBestChild(node, game.get_player_to_move(), self.explorationConstant)
+                undoRecords.append(game.take_action(g.Game.Action.from_id(self.actionId[node]), record=True))
+                path.append(node)
+            else:
+                if self.numNodes() < self.maxNodes:
+                    actions = game.get_possible_actions()
+                    action = actions[self.numExpanded[node]]
+                    self.numExpanded[node] += 1
+                    if self.numExpanded[node] == len(actions):
+                        flags[node] |= self.FULLY_EXPANDED
+                    undoRecords.append(game.take_action(action, record=True))
+                    node = self.addNode(node, action.to_id(), game.is_terminal())
+                    path.append(node)
+                break
+
+        reward = self.rollout(game)
+
+        for node in path:
+            self.numVisits[node] += 1
+            self.totalReward[node] += reward
+
+        for undoRecord in reversed(undoRecords):
+            game.undo(undoRecord)
+
+    def getBestChild(self, node, player, explorationValue):
+        numVisits = self.numVisits
+        totalReward = self.totalReward
+        logParentVisits = math.log(numVisits[node]) if numVisits[node] > 0 else 0
+        bestValue = float("-inf")
+        bestNodes = []
+        child = self.firstChild[node]
+        while child != -1:
+            nodeValue = player * totalReward[child] / numVisits[child] + explorationValue * math.sqrt(
+                2 * logParentVisits / numVisits[child])
             if nodeValue > bestValue:
                 bestValue = nodeValue
                 bestNodes = [child]
             elif nodeValue == bestValue:
                 bestNodes.append(child)
+            child = self.nextSibling[child]
         return random.choice(bestNodes)
+
+
+# Plays one turn from game with chooseAction on a copy of it, and returns the turn's actions as a tuple along with the
+# copy, which is left at the end of the turn. The turn ends when play passes to the other player or the game is over
+def sampleTurn(game2, chooseAction=heuristicAction):
+    game = game2.clone()
+    player = game.get_player_to_move()
+    bundle = []
+    while game.get_player_to_move() == player and not game.is_terminal():
+        action = chooseAction(game, game.get_possible_actions())
+        game.take_action(action)
+        bundle.append(action)
+    return tuple(bundle), game
+
+
+class turnNode(treeNode):
+    def __init__(self, game, parent, stats=None, key=None, sign=1):
+        super().__init__(game, parent, stats, key, sign)
+        # the turns that haven't been given a child yet, sampled when the node is first expanded
+        self.untriedTurns = None
+
+
+# mcts where every edge of the tree is a whole turn instead of a single action, so each level of the tree is a move by
+# the other player. A turn has far too many orderings of its actions to list, so each node gets numTurns turns sampled
+# with chooseAction, pruned to one per position they end on. search() returns the chosen turn as a tuple of actions
+class turnMcts(mcts):
+    def __init__(self, timeLimit=None, iterationLimit=None, explorationConstant=1 / math.sqrt(2),
+                 rolloutPolicy=randomPolicy, transpositionTable=None, keepTree=False, foldSymmetry=False, numTurns=16,
+                 chooseAction=heuristicAction):
+        super().__init__(timeLimit=timeLimit, iterationLimit=iterationLimit, explorationConstant=explorationConstant,
+                         rolloutPolicy=rolloutPolicy, transpositionTable=transpositionTable, keepTree=keepTree,
+                         foldSymmetry=foldSymmetry)
+        self.numTurns = numTurns
+        self.chooseAction = chooseAction
+
+    def expand(self, node):
+        if node.untriedTurns is None:
+            node.untriedTurns = self.sampleTurns(node.game)
+        bundle, newGame = node.untriedTurns.pop()
+        newNode = self.makeNode(newGame, node)
+        node.children[bundle] = newNode
+        if not node.untriedTurns:
+            node.isFullyExpanded = True
+        return newNode
+
+    # Returns (turn, game after it) pairs for up to numTurns different positions
+    def sampleTurns(self, game):
+        turns = {}
+        for i in range(self.numTurns):
+            bundle, newGame = sampleTurn(game, self.chooseAction)
+            turns.setdefault(newGame.get_hash(), (bundle, newGame))
+        return list(turns.values())
+
+    def makeNode(self, game, parent):
+        key, sign = self.nodeKey(game)
+        return turnNode(game, parent, self.table.lookup(key), key, sign)
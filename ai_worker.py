@@ -0,0 +1,28 @@
+import os
+import sys
+import time
+
+# The worker always shares the database with the web server processes
+os.environ['SHARED_SESSIONS'] = '1'
+
+import frontend
+
+
+# Plays the AI's turns for web servers running with SHARED_SESSIONS=1: claims games that are waiting for Black to move
+# from the session database and plays their turns, checking for more every poll seconds when there are none. Run as
+# many of these processes as there are cores to spare. A worker that dies in the middle of a turn loses its claim when
+# the lease runs out, and another worker finishes the turn
+def main(poll=0.1):
+    while True:
+        session = frontend.store.claim()
+        if session is None:
+            time.sleep(poll)
+            continue
+        frontend.play_ai_turn(session)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(float(sys.argv[1]))
+    else:
+        main()
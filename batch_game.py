@@ -0,0 +1,366 @@
+from array import array
+
+import numpy
+
+from game import Game, _BOARD_SIZE, _IS_CITY
+
+# Channels of BatchGame.board, in the same order as the channels of Game._board
+PIECES = 0
+HEALTH = 1
+MOVE_READY = 2
+ATTACK_READY = 3
+BLESS = 4
+CITIES = 5
+NUM_CHANNELS = _BOARD_SIZE // 64
+
+Action = Game.Action
+
+# Rule tables indexed by piece type (index 0 is unused)
+_MAX_HEALTH = numpy.array([0] + [Game._M_MAP[piece_type] for piece_type in range(1, 8)], dtype=numpy.int8)
+_ATTACK = numpy.array([0] + [Game._A_MAP[piece_type] for piece_type in range(1, 8)], dtype=numpy.int8)
+_RETALIATION = numpy.array([0] + [Game._R_MAP[piece_type] for piece_type in range(1, 8)], dtype=numpy.int8)
+_COST = numpy.array([0] + [Game._C_MAP[piece_type] for piece_type in range(1, 8)], dtype=numpy.int64)
+
+_IS_CITY_MASK = numpy.array(_IS_CITY)
+_PIECE_BITS = numpy.arange(1, 8)
+
+# _NEIGHBOUR[square, heading] is the adjacent square in that heading and _RANGED[square, heading] the one after it, as
+# listed in Action.HEADINGS. Off the board they point at square 64, which is a padding column that is always empty
+_OFF_BOARD = 64
+_NEIGHBOUR = numpy.full((64, 8), _OFF_BOARD, dtype=numpy.int64)
+_RANGED = numpy.full((64, 8), _OFF_BOARD, dtype=numpy.int64)
+for _square in range(64):
+    for _heading_index, (_row_heading, _col_heading) in enumerate(Action.HEADINGS):
+        _row, _col = _square // 8, _square % 8
+        if 0 <= _row + _row_heading <= 7 and 0 <= _col + _col_heading <= 7:
+            _NEIGHBOUR[_square, _heading_index] = _square + _row_heading * 8 + _col_heading
+        if 0 <= _row + 2 * _row_heading <= 7 and 0 <= _col + 2 * _col_heading <= 7:
+            _RANGED[_square, _heading_index] = _square + 2 * (_row_heading * 8 + _col_heading)
+_HAS_NEIGHBOUR = _NEIGHBOUR != _OFF_BOARD
+_HAS_RANGED = _RANGED != _OFF_BOARD
+
+
+# N games of the same rules as game.Game, stored as stacked NumPy arrays so that move generation and taking actions
+# happen for all of them at once. Actions are referred to by their ids (see Game.Action.to_id), and every method works
+# on the whole batch: legal_mask() returns one row of legal action ids per game, and take_action() takes one action id
+# per game
+class BatchGame:
+    def __init__(self, size):
+        self.size = size
+
+        # board[game, channel, square], laid out like Game._board
+        self.board = numpy.zeros((size, NUM_CHANNELS, 64), dtype=numpy.int8)
+        self.player_to_move = numpy.ones(size, dtype=numpy.int8)
+        self.economy_phase = numpy.zeros(size, dtype=bool)
+        self.white_money = numpy.zeros(size, dtype=numpy.int64)
+        self.black_money = numpy.ones(size, dtype=numpy.int64)
+        self.white_research = numpy.full(size, 1 << 1, dtype=numpy.int64)
+        self.black_research = numpy.full(size, 1 << 1, dtype=numpy.int64)
+        self.white_cities = numpy.ones(size, dtype=numpy.int64)
+        self.black_cities = numpy.ones(size, dtype=numpy.int64)
+        self.white_pieces = numpy.ones(size, dtype=numpy.int64)
+        self.black_pieces = numpy.ones(size, dtype=numpy.int64)
+        self.white_material = numpy.full(size, Game._C_MAP[1], dtype=numpy.int64)
+        self.black_material = numpy.full(size, Game._C_MAP[1], dtype=numpy.int64)
+
+        starting_board = numpy.frombuffer(Game()._board, dtype=numpy.int8).reshape(NUM_CHANNELS, 64)
+        self.board[:] = starting_board
+
+    @classmethod
+    def from_games(cls, games):
+        batch = cls(len(games))
+        for index, game in enumerate(games):
+            batch.board[index] = numpy.frombuffer(game._board, dtype=numpy.int8).reshape(NUM_CHANNELS, 64)
+            batch.player_to_move[index] = game._player_to_move
+            batch.economy_phase[index] = game._economy_phase
+            batch.white_money[index] = game._white_money
+            batch.black_money[index] = game._black_money
+            batch.white_research[index] = game._white_research
+            batch.black_research[index] = game._black_research
+            batch.white_cities[index] = game._white_cities
+            batch.black_cities[index] = game._black_cities
+            batch.white_pieces[index] = game._white_pieces
+            batch.black_pieces[index] = game._black_pieces
+            batch.white_material[index] = game._white_material
+            batch.black_material[index] = game._black_material
+        return batch
+
+    # Builds a game.Game holding the position of one game in the batch
+    def to_game(self, index):
+        game = Game()
+        game._board = array("b", self.board[index].tobytes())
+        game._player_to_move = int(self.player_to_move[index])
+        game._economy_phase = bool(self.economy_phase[index])
+        game._white_money = int(self.white_money[index])
+        game._black_money = int(self.black_money[index])
+        game._white_research = int(self.white_research[index])
+        game._black_research = int(self.black_research[index])
+        game._white_cities = int(self.white_cities[index])
+        game._black_cities = int(self.black_cities[index])
+        game._white_pieces = int(self.white_pieces[index])
+        game._black_pieces = int(self.black_pieces[index])
+        game._white_material = int(self.white_material[index])
+        game._black_material = int(self.black_material[index])
+        game._board_key = game._compute_board_key()
+        game._piece_actions = [None] * 64
+        return game
+
+    def get_rewards(self):
+        white = self.white_cities > 0
+        black = self.black_cities > 0
+        return (white & ~black).astype(numpy.int8) - (black & ~white).astype(numpy.int8)
+
+    def is_terminal(self):
+        return self.get_rewards() != 0
+
+    # Pads a channel with an always empty 65th square, so off board neighbours can be looked up like any other
+    def _padded(self, channel):
+        return numpy.pad(self.board[:, channel], ((0, 0), (0, 1)))
+
+    def _research_bits(self):
+        research = numpy.where(self.player_to_move == 1, self.white_research, self.black_research)
+        return (research[:, None] >> _PIECE_BITS) & 1 == 1
+
+    # Returns a (size, Action.NUM_IDS) boolean array whose row i marks the legal actions of game i, the same set as
+    # Game.get_possible_actions would give
+    def legal_mask(self):
+        size = self.size
+        board = self.board
+        player = self.player_to_move.astype(numpy.int8)
+        pieces = board[:, PIECES]
+        move_ready = board[:, MOVE_READY]
+        attack_ready = board[:, ATTACK_READY]
+        cities = board[:, CITIES]
+        kind = numpy.abs(pieces)
+        own = pieces * player[:, None] > 0
+
+        padded_pieces = self._padded(PIECES)
+        # the sign of each neighbour relative to the player to move: positive for an ally, negative for an enemy
+        neighbour = padded_pieces[:, _NEIGHBOUR] * player[:, None, None]
+        ranged = padded_pieces[:, _RANGED] * player[:, None, None]
+        neighbour_blessed = self._padded(BLESS)[:, _NEIGHBOUR] != 0
+
+        mask = numpy.zeros((size, Action.NUM_IDS), dtype=bool)
+
+        # Move
+        can_move = (own & (move_ready > 0))[:, :, None]
+        moves = can_move & _HAS_NEIGHBOUR & (neighbour == 0)
+        mask[:, Action.MOVE_BASE:Action.ATTACK_BASE] = moves.reshape(size, 64 * 8)
+
+        # Attack, including Support blessings and Archer ranged attacks
+        can_attack = (own & (attack_ready > 0))[:, :, None]
+        enemy = _HAS_NEIGHBOUR & (neighbour < 0)
+        bless = (kind == 6)[:, :, None] & (neighbour > 0) & ~neighbour_blessed
+        ranged_attack = (kind == 5)[:, :, None] & _HAS_RANGED & (ranged < 0)
+        attacks = can_attack & (enemy | (~enemy & (bless | ranged_attack)))
+        mask[:, Action.ATTACK_BASE:Action.CAPTURE_BASE] = attacks.reshape(size, 64 * 8)
+
+        # Capture
+        captures = (own & _IS_CITY_MASK & (cities != player[:, None]) & (move_ready >= 1) &
+                    ((kind != 2) | (move_ready >= 2)))
+        mask[:, Action.CAPTURE_BASE:Action.RESEARCH_BASE] = captures
+
+        researched = self._research_bits()
+        economy_phase = self.economy_phase
+
+        # Research and Economy
+        mask[:, Action.RESEARCH_BASE:Action.ECONOMY_ID] = ~economy_phase[:, None] & ~researched
+        mask[:, Action.ECONOMY_ID] = ~economy_phase
+
+        # Place
+        money = numpy.where(self.player_to_move == 1, self.white_money, self.black_money)
+        open_cities = _IS_CITY_MASK & (cities == player[:, None]) & (pieces == 0) & economy_phase[:, None]
+        affordable = researched & (money[:, None] > _COST[1:])
+        places = open_cities[:, :, None] & affordable[:, None, :]
+        mask[:, Action.PLACE_BASE:Action.END_TURN_ID] = places.reshape(size, 64 * 7)
+
+        # End Turn
+        mask[:, Action.END_TURN_ID] = economy_phase
+
+        return mask
+
+    # Plays action_ids[i] in game i. Games where active is False (or whose id is negative) are left alone. The actions
+    # are expected to be legal, as given by legal_mask()
+    def take_action(self, action_ids, active=None):
+        action_ids = numpy.asarray(action_ids, dtype=numpy.int64)
+        if active is None:
+            active = action_ids >= 0
+        else:
+            active = active & (action_ids >= 0)
+
+        games = numpy.flatnonzero(active)
+        ids = action_ids[games]
+
+        def select(low, high):
+            chosen = (ids >= low) & (ids < high)
+            return games[chosen], ids[chosen] - low
+
+        move_games, move_ids = select(Action.MOVE_BASE, Action.ATTACK_BASE)
+        attack_games, attack_ids = select(Action.ATTACK_BASE, Action.CAPTURE_BASE)
+        capture_games, capture_squares = select(Action.CAPTURE_BASE, Action.RESEARCH_BASE)
+        research_games, research_types = select(Action.RESEARCH_BASE, Action.ECONOMY_ID)
+        economy_games, _ = select(Action.ECONOMY_ID, Action.ECONOMY_ID + 1)
+        place_games, place_ids = select(Action.PLACE_BASE, Action.END_TURN_ID)
+        end_turn_games, _ = select(Action.END_TURN_ID, Action.END_TURN_ID + 1)
+
+        self._move(move_games, move_ids // 8, _NEIGHBOUR[move_ids // 8, move_ids % 8])
+        self._attack(attack_games, attack_ids // 8, attack_ids % 8)
+        self._capture(capture_games, capture_squares)
+        self._research(research_games, research_types + 1)
+        self._economy(economy_games)
+        self._place(place_games, place_ids // 7, place_ids % 7 + 1)
+        self._end_turn(end_turn_games)
+
+    def _move(self, games, squares, targets):
+        board = self.board
+        board[games, :BLESS + 1, targets] = board[games, :BLESS + 1, squares]
+        board[games, MOVE_READY, targets] -= 1
+        board[games, :BLESS + 1, squares] = 0
+
+    def _attack(self, games, squares, headings):
+        board = self.board
+        player = self.player_to_move[games]
+        # every legal attack has a neighbour in its heading, even ranged ones
+        targets = _NEIGHBOUR[squares, headings]
+        attacker_type = numpy.abs(board[games, PIECES, squares])
+        victim = board[games, PIECES, targets]
+        victim_type = numpy.abs(victim)
+
+        # whatever kind of attack it is, the attacker is spent (a Berserker gets its attack back below if it kills)
+        board[games, MOVE_READY, squares] = 0
+        board[games, ATTACK_READY, squares] = 0
+
+        enemy = victim * player < 0
+
+        # Archers shooting at distance 2
+        archer = ~enemy & (attacker_type == 5)
+        self._hit(games[archer], _RANGED[squares[archer], headings[archer]], _ATTACK[5])
+
+        # Supports blessing an ally
+        support = ~enemy & (attacker_type == 6)
+        board[games[support], BLESS, targets[support]] = 1
+
+        # Blessed victims only lose their bless, and hit back with one more than their R
+        blessed = enemy & (board[games, BLESS, targets] == 1)
+        board[games[blessed], BLESS, targets[blessed]] = 0
+        self._hit(games[blessed], squares[blessed], _RETALIATION[victim_type[blessed]] + 1)
+
+        melee = enemy & ~blessed
+        games, squares, targets = games[melee], squares[melee], targets[melee]
+        attacker_type, victim_type = attacker_type[melee], victim_type[melee]
+        kill = self._hit(games, targets, _ATTACK[attacker_type])
+
+        # Killers move in, after a Berserker readies again and a Defender deals its parting damage
+        berserker = kill & (attacker_type == 7)
+        board[games[berserker], ATTACK_READY, squares[berserker]] = 1
+        defender = kill & (victim_type == 3)
+        self._hit(games[defender], squares[defender], numpy.ones(numpy.count_nonzero(defender), dtype=numpy.int8))
+        board[games[kill], :BLESS + 1, targets[kill]] = board[games[kill], :BLESS + 1, squares[kill]]
+        board[games[kill], :BLESS + 1, squares[kill]] = 0
+
+        # Survivors retaliate
+        survived = ~kill
+        self._hit(games[survived], squares[survived], _RETALIATION[victim_type[survived]])
+
+    # Deals damage to the pieces on squares, taking them off the board if they die. Blessed pieces lose their bless
+    # instead. Returns which of them died
+    def _hit(self, games, squares, damage):
+        board = self.board
+        damage = numpy.broadcast_to(numpy.asarray(damage, dtype=numpy.int8), games.shape)
+        blessed = board[games, BLESS, squares] == 1
+        board[games[blessed], BLESS, squares[blessed]] = 0
+
+        hurt = ~blessed
+        board[games[hurt], HEALTH, squares[hurt]] -= damage[hurt]
+        died = hurt & (board[games, HEALTH, squares] <= 0)
+        self._remove(games[died], squares[died])
+        return died
+
+    # Takes dead pieces off the board
+    def _remove(self, games, squares):
+        board = self.board
+        pieces = board[games, PIECES, squares]
+        white = pieces > 0
+        numpy.subtract.at(self.white_pieces, games[white], 1)
+        numpy.subtract.at(self.white_material, games[white], _COST[pieces[white]])
+        numpy.subtract.at(self.black_pieces, games[~white], 1)
+        numpy.subtract.at(self.black_material, games[~white], _COST[-pieces[~white]])
+        board[games, :BLESS + 1, squares] = 0
+
+    def _capture(self, games, squares):
+        board = self.board
+        player = self.player_to_move[games]
+        previous_owner = board[games, CITIES, squares]
+        self.white_cities[games] += (player == 1).astype(numpy.int64) - (previous_owner == 1)
+        self.black_cities[games] += (player == -1).astype(numpy.int64) - (previous_owner == -1)
+        board[games, CITIES, squares] = player
+        board[games, MOVE_READY, squares] = 0
+        board[games, ATTACK_READY, squares] = 0
+
+    def _research(self, games, piece_types):
+        white = self.player_to_move[games] == 1
+        self.white_research[games[white]] |= 1 << piece_types[white]
+        self.black_research[games[~white]] |= 1 << piece_types[~white]
+        self._unready(games)
+        self._end_turn(games)
+
+    def _economy(self, games):
+        self.economy_phase[games] = True
+        self._unready(games)
+        white = self.player_to_move[games] == 1
+        self.white_money[games[white]] += self.white_cities[games[white]]
+        self.black_money[games[~white]] += self.black_cities[games[~white]]
+
+    def _place(self, games, squares, piece_types):
+        board = self.board
+        player = self.player_to_move[games]
+        cost = _COST[piece_types]
+        white = player == 1
+        self.white_money[games[white]] -= cost[white]
+        self.white_pieces[games[white]] += 1
+        self.white_material[games[white]] += cost[white]
+        self.black_money[games[~white]] -= cost[~white]
+        self.black_pieces[games[~white]] += 1
+        self.black_material[games[~white]] += cost[~white]
+        board[games, PIECES, squares] = player * piece_types
+        board[games, HEALTH, squares] = _MAX_HEALTH[piece_types]
+
+    def _end_turn(self, games):
+        self.player_to_move[games] *= -1
+        self.economy_phase[games] = False
+        self._ready(games)
+
+    def _unready(self, games):
+        self.board[games, MOVE_READY:ATTACK_READY + 1] = 0
+
+    def _ready(self, games):
+        board = self.board
+        pieces = board[games, PIECES]
+        own = pieces * self.player_to_move[games][:, None] > 0
+        runner = numpy.abs(pieces) == 2
+        board[games, MOVE_READY] = numpy.where(own, numpy.where(runner, 2, 1), board[games, MOVE_READY])
+        board[games, ATTACK_READY] = numpy.where(own, 1, board[games, ATTACK_READY])
+
+    # Picks a uniformly random legal action in every game that isn't over yet (-1 for those that are)
+    def random_actions(self, rng):
+        mask = self.legal_mask()
+        mask[self.is_terminal()] = False
+        games, action_ids = numpy.nonzero(mask)
+        if len(action_ids) == 0:
+            return numpy.full(self.size, -1, dtype=numpy.int64)
+
+        # the legal ids of each game are contiguous in action_ids, so pick a random offset into each game's run
+        counts = numpy.bincount(games, minlength=self.size)
+        starts = numpy.cumsum(counts) - counts
+        offsets = (rng.random(self.size) * counts).astype(numpy.int64)
+        choices = action_ids[numpy.minimum(starts + offsets, len(action_ids) - 1)]
+        return numpy.where(counts > 0, choices, -1)
+
+    # Plays random actions in every game until they are all over or max_plies have been played, and returns the rewards
+    def random_playout(self, rng, max_plies=10000):
+        for _ in range(max_plies):
+            actions = self.random_actions(rng)
+            if numpy.all(actions < 0):
+                break
+            self.take_action(actions)
+        return self.get_rewards()
@@ -0,0 +1,268 @@
+import copy
+import os
+import random
+import sys
+import time
+
+import game
+
+
+# Plays random actions from the starting position to get a mid-game board with a few pieces on it
+def _midgame(plies=200, seed=0):
+    rng = random.Random(seed)
+    game_state = game.Game()
+    for _ in range(plies):
+        if game_state.is_terminal():
+            break
+        game_state.take_action(rng.choice(game_state.get_possible_actions()))
+    return game_state
+
+
+# Calls f() repeatedly for about `seconds` and returns how many calls per second it managed
+def _rate(f, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        for _ in range(100):
+            f()
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def bench_clone():
+    game_state = _midgame()
+
+    # This is what copy.deepcopy(game_state) did before Game defined __deepcopy__: rebuild the object from its reduced
+    # form, deep copying every attribute along the way
+    def generic_deepcopy():
+        return copy._reconstruct(game_state, {}, *game_state.__reduce_ex__(4))
+
+    before = _rate(generic_deepcopy)
+    after = _rate(game_state.clone)
+    print("clone: generic deepcopy %.0f/s, Game.clone %.0f/s (%.1fx)" % (before, after, after / before))
+
+
+# How many random plies per second the move generator can drive, with and without its cache. That both give the same
+# actions as the generator from before the flat board is checked by test_game.py
+def bench_movegen(seconds=2.0):
+    for name, generate in (("uncached", game.Game._get_possible_actions_uncached),
+                           ("cached", game.Game.get_possible_actions)):
+        rng = random.Random(1)
+        game_state = game.Game()
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() < start + seconds:
+            if game_state.is_terminal():
+                game_state = game.Game()
+            game_state.take_action(rng.choice(generate(game_state)))
+            count += 1
+        print("movegen: %s %.0f random plies/s" % (name, count / (time.perf_counter() - start)))
+
+
+# Plays the same random actions in a batch_game.BatchGame and in one game.Game per board, checking that both engines
+# agree on the legal actions and the resulting positions, then times random plies/s for a batch of each size
+def bench_batch(size=64, plies=1000, sizes=(1, 64, 1024), seconds=2.0):
+    import numpy
+    import batch_game
+
+    rng = random.Random(0)
+    games = [game.Game() for _ in range(size)]
+    batch = batch_game.BatchGame(size)
+    for _ in range(plies):
+        mask = batch.legal_mask()
+        actions = numpy.full(size, -1)
+        for index, game_state in enumerate(games):
+            if game_state.is_terminal():
+                continue
+            action_ids = sorted(action.to_id() for action in game_state.get_possible_actions())
+            if action_ids != numpy.flatnonzero(mask[index]).tolist():
+                raise Exception("BatchGame legal actions differ from Game in board %d" % index)
+            actions[index] = rng.choice(action_ids)
+            game_state.take_action(game.Game.Action.from_id(actions[index]))
+        batch.take_action(actions)
+        for index, game_state in enumerate(games):
+            if batch.to_game(index).get_hash() != game_state.get_hash():
+                raise Exception("BatchGame position differs from Game in board %d" % index)
+    print("batch: BatchGame matched Game for %d boards over %d plies" % (size, plies))
+
+    numpy_rng = numpy.random.default_rng(0)
+    for batch_size in sizes:
+        batch = batch_game.BatchGame(batch_size)
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() < start + seconds:
+            actions = batch.random_actions(numpy_rng)
+            batch.take_action(actions)
+            count += numpy.count_nonzero(actions >= 0)
+            if batch.is_terminal().all():
+                batch = batch_game.BatchGame(batch_size)
+        print("batch: %d boards %.0f random plies/s" % (batch_size, count / (time.perf_counter() - start)))
+
+
+def _worker_counts():
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+    if counts[-1] != os.cpu_count():
+        counts.append(os.cpu_count())
+    return counts
+
+
+# MCTS playouts per second with root parallel search, from one worker up to one per core
+def bench_parallel(time_limit=1000, searches=3):
+    import ai_agent
+
+    game_state = _midgame(300, seed=2)
+    for workers in _worker_counts():
+        searcher = ai_agent.mcts(timeLimit=time_limit, workers=workers)
+        searcher.search(game_state)  # warm up the process pool
+        rounds = 0
+        start = time.perf_counter()
+        for _ in range(searches):
+            searcher.search(game_state)
+            rounds += searcher.rounds
+        print("parallel: %d workers %.0f playouts/s" % (workers, rounds / (time.perf_counter() - start)))
+
+
+# Plays AIAgents with more workers against a single worker AIAgent, swapping colours every game. Games that go past
+# max_plies are scored by who holds more cities
+def bench_parallel_strength(time_limit=200, games=4, max_plies=300):
+    import ai_agent
+
+    for workers in _worker_counts()[1:]:
+        score = 0
+        for game_number in range(games):
+            parallel_colour = 1 if game_number % 2 == 0 else -1
+            agents = {parallel_colour: ai_agent.AIAgent(time_limit, workers), -parallel_colour: ai_agent.AIAgent(time_limit)}
+            game_state = game.Game()
+            for _ in range(max_plies):
+                if game_state.is_terminal():
+                    break
+                game_state.take_action(agents[game_state.get_player_to_move()].decide_action(game_state))
+            summary = game_state.get_summary()
+            result = summary["reward"] or (summary["white_cities"] > summary["black_cities"]) - (
+                summary["white_cities"] < summary["black_cities"])
+            score += result * parallel_colour
+        print("parallel strength: %d workers vs 1 worker, net score %+d over %d games" % (workers, score, games))
+
+
+# Rollouts per second of each rollout policy from a mid-game position
+def bench_rollouts(seconds=5.0):
+    import ai_agent
+
+    game_state = _midgame(300, seed=2)
+    policies = (
+        ("random to the end", ai_agent.randomPolicy),
+        ("heuristic to the end", ai_agent.cutoffPolicy(maxPlies=None)),
+        ("random, 200 ply cutoff", ai_agent.cutoffPolicy(chooseAction=ai_agent.randomAction)),
+        ("heuristic, 200 ply cutoff", ai_agent.cutoffPolicy()),
+        ("static evaluation only", ai_agent.cutoffPolicy(maxPlies=0)),
+    )
+    for name, policy in policies:
+        random.seed(0)
+        count = 0
+        start = time.perf_counter()
+        while count == 0 or time.perf_counter() < start + seconds:
+            policy(game_state)
+            count += 1
+        print("rollouts: %s %.1f/s" % (name, count / (time.perf_counter() - start)))
+
+
+# Plays an AIAgent that rolls out with cutoffPolicy() against one with the default randomPolicy, swapping colours every
+# game. Games that go past max_plies are scored by who holds more cities
+def bench_rollout_strength(time_limit=500, games=6, max_plies=400):
+    import ai_agent
+
+    score = 0
+    for game_number in range(games):
+        cutoff_colour = 1 if game_number % 2 == 0 else -1
+        agents = {cutoff_colour: ai_agent.AIAgent(time_limit, rolloutPolicy=ai_agent.cutoffPolicy()),
+                  -cutoff_colour: ai_agent.AIAgent(time_limit)}
+        game_state = game.Game()
+        for _ in range(max_plies):
+            if game_state.is_terminal():
+                break
+            game_state.take_action(agents[game_state.get_player_to_move()].decide_action(game_state))
+        summary = game_state.get_summary()
+        result = summary["reward"] or (summary["white_cities"] > summary["black_cities"]) - (
+            summary["white_cities"] < summary["black_cities"])
+        score += result * cutoff_colour
+    print("rollout strength: cutoffPolicy vs randomPolicy, net score %+d over %d games" % (score, games))
+
+
+def _static_rollout(game_state):
+    return game_state.get_reward()
+
+
+# Memory held per tree node by mcts (treeNode objects, each with its own game) and by arenaMcts (flat arrays), measured
+# with tracemalloc after searches that skip the rollout so the tree grows quickly
+def bench_tree_memory(iterations=20000):
+    import tracemalloc
+    import ai_agent
+
+    game_state = _midgame(300, seed=2)
+    print("tree memory: arenaMcts columns add up to %d bytes per node" % ai_agent.arenaMcts.bytesPerNode())
+    for searcher in (ai_agent.mcts(iterationLimit=iterations, rolloutPolicy=_static_rollout),
+                     ai_agent.arenaMcts(iterationLimit=iterations, rolloutPolicy=_static_rollout)):
+        tracemalloc.start()
+        searcher.search(game_state)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        if isinstance(searcher, ai_agent.arenaMcts):
+            nodes = searcher.numNodes()
+        else:
+            nodes = 0
+            stack = [searcher.root]
+            while stack:
+                node = stack.pop()
+                nodes += 1
+                stack.extend(node.children.values())
+        print("tree memory: %s %d nodes, %.0f bytes per node" % (type(searcher).__name__, nodes, used / nodes))
+
+
+# How deep the tree of mcts and of turnMcts gets for the same number of rounds, in tree levels and in changes of the
+# player to move along the deepest line
+def bench_turn_depth(iterations=2000):
+    import ai_agent
+
+    game_state = _midgame(300, seed=2)
+    for searcher in (ai_agent.mcts(iterationLimit=iterations, rolloutPolicy=_static_rollout),
+                     ai_agent.turnMcts(iterationLimit=iterations, rolloutPolicy=_static_rollout)):
+        random.seed(0)
+        start = time.perf_counter()
+        searcher.search(game_state)
+        elapsed = time.perf_counter() - start
+        deepest = (0, 0)
+        stack = [(searcher.root, 0, 0)]
+        while stack:
+            node, depth, turns = stack.pop()
+            deepest = max(deepest, (depth, turns))
+            for child in node.children.values():
+                turn_over = child.game.get_player_to_move() != node.game.get_player_to_move()
+                stack.append((child, depth + 1, turns + turn_over))
+        print("turn depth: %s %d levels, %d turns deep (%.1fs)" % (type(searcher).__name__, deepest[0], deepest[1],
+                                                                   elapsed))
+
+
+BENCHMARKS = {
+    "clone": bench_clone,
+    "movegen": bench_movegen,
+    "batch": bench_batch,
+    "parallel": bench_parallel,
+    "parallel_strength": bench_parallel_strength,
+    "rollouts": bench_rollouts,
+    "rollout_strength": bench_rollout_strength,
+    "tree_memory": bench_tree_memory,
+    "turn_depth": bench_turn_depth,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
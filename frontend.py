@@ -1,13 +1,42 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
 from game import Game
 
-from flask import Flask, send_file, send_from_directory, request, make_response, json
+from flask import Flask, Response, send_file, send_from_directory, request, make_response, json
+
+from ai_agent import AIAgent, heuristicAction
 
-from ai_agent import AIAgent
+from session_store import SessionStore
 
 adversary = AIAgent
 
-games = []
-agents = []
+# where games are saved, and how many sessions are kept in memory and for how long (see SessionStore)
+session_database = os.environ.get('SESSION_DATABASE', 'sessions.db')
+max_sessions = 1000
+session_ttl = 30 * 60
+
+# Set SHARED_SESSIONS=1 to run several server processes on one database, e.g. gunicorn -w 8 frontend:app, with AI turns
+# played by separate ai_worker.py processes. Each process then checks the database for changes made by the others every
+# shared_poll seconds while a client is waiting for them
+shared_sessions = os.environ.get('SHARED_SESSIONS') == '1'
+shared_poll = 0.25
+
+# Unless sessions are shared, Black's turns are played here rather than in the request that ended White's turn, at most
+# ai_workers at once. The request returns straight away with thinking set, and the client polls with ?wait=<seconds>
+# until it isn't
+ai_workers = 4
+ai_pool = ThreadPoolExecutor(max_workers=ai_workers)
+# how many times an AI action that fails is tried again with a new agent before the rest of the turn is played with
+# heuristicAction instead, so a broken search can't leave the game stuck with Black to move
+ai_retries = 2
+max_wait = 30
+# /game/events sends a comment this often while nothing happens, so dropped connections are noticed
+heartbeat = 15
 
 app = Flask(__name__, static_url_path='', static_folder='static')
 
@@ -23,6 +52,179 @@ def index():
 def game():
     return send_file('./views/game.html')
 
+# Plays Black's actions until it is White's turn again. The AI searches a copy of the game, so the game is only locked
+# while an action is taken
+def play_ai_turn(session):
+    game = session.game
+    failures = 0
+    try:
+        while True:
+            with session.lock:
+                if game.get_player_to_move() != -1 or game.is_terminal():
+                    return
+                position = game.clone()
+            try:
+                if failures <= ai_retries:
+                    action = session.agent.decide_action(position)
+                else:
+                    action = heuristicAction(position, position.get_possible_actions())
+                with store.change(session):
+                    game.take_action(action)
+                    session.channel.publish(game, True, action)
+            except Exception:
+                failures += 1
+                app.logger.exception("AI action %d of session %s failed (%d so far this turn)", game.history,
+                                     session.user, failures)
+                # past the retries even heuristicAction has failed, so the game itself is broken
+                if failures > ai_retries + 1:
+                    return
+                session.agent = adversary()
+    except Exception:
+        app.logger.exception("AI turn of session %s failed", session.user)
+    finally:
+        with store.change(session):
+            session.thinking = False
+            session.channel.publish(game, False)
+
+
+def start_ai_turn(session):
+    with store.lock:
+        session.ai_turn = ai_pool.submit(play_ai_turn, session)
+
+
+# The changes to one game, for /game/events and ?since=. Each action taken, and each time the AI starts or stops
+# thinking, becomes an event holding the action (None if only thinking changed) and the fields of state() whose values
+# changed. An event's id comes from the game rather than from the channel: the number of actions played and whether the
+# AI is thinking, which together always name the same state, so a client that reconnects with Last-Event-ID can catch
+# up from any process's channel, or one rebuilt after the session was dropped, as long as the channel has that event
+# among the last max_events or is still at it. Within a channel, events are numbered in the order they were published
+class GameChannel:
+    max_events = 256
+
+    def __init__(self, game, thinking=False):
+        self.condition = threading.Condition()
+        # (number, id, data, version, action, cells, delta) of each event, where cells are the (field, row, column,
+        # value) of the board cells it changed
+        self.events = deque(maxlen=self.max_events)
+        # how many events this channel has published
+        self.count = 0
+        self.fields = state(game, thinking)
+        self.first_version = game.history
+        # the /game/events streams reading this channel
+        self.subscribers = 0
+
+    # The id of the state in fields, which is also the id of the event that led to it
+    def event_id(self):
+        return '%d-%d' % (self.fields['version'], self.fields['thinking'])
+
+    # Called with the game's lock held, so events are published in the order the changes were made
+    def publish(self, game, thinking, action=None):
+        fields = state(game, thinking)
+        delta = {key: value for key, value in fields.items() if self.fields[key] != value}
+        if action is None and not delta:
+            return
+        cells = [(field, i, j, value) for field in BOARD_FIELDS if field in delta
+                 for i, (old_row, row) in enumerate(zip(self.fields[field], fields[field]))
+                 for j, (old_value, value) in enumerate(zip(old_row, row)) if old_value != value]
+        with self.condition:
+            self.fields = fields
+            self.count += 1
+            event_id = self.event_id()
+            description = describe_action(action)
+            self.events.append((self.count, event_id, json.dumps({
+                'event': event_id,
+                'action': description,
+                'delta': delta
+            }), fields['version'], description, cells, delta))
+            self.condition.notify_all()
+
+    # The number of the last event with this id, to send the events after it. None if the channel doesn't know it,
+    # in which case the client needs the whole state again
+    def position(self, event_id):
+        with self.condition:
+            if event_id == self.event_id():
+                return self.count
+            for number, other_id, *_ in reversed(self.events):
+                if other_id == event_id:
+                    return number
+            return None
+
+    # The (id, data) of the events after the one numbered position, waiting up to timeout for one if there are none
+    # yet. None if some of them have already been dropped, in which case the client needs the whole state again
+    def events_after(self, position, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.count != position, timeout)
+            if self.count - position > len(self.events) or position > self.count:
+                return None
+            return [(event_id, data) for number, event_id, data, *_ in self.events if number > position]
+
+    # What changed since the client's version, for ?since=: the actions played after it, the board cells that changed
+    # as [row, column, value] by field, and the current value of the other fields that changed. It is put together from
+    # the events after the first one that reached that version, which may include a few the client already has, but
+    # those only repeat values. None if the channel has no event at that version, or has dropped some of the events
+    # after it, in which case the client needs the whole state again
+    def changes_since(self, version, thinking):
+        with self.condition:
+            if version == self.fields['version']:
+                position = self.count
+            elif version == self.first_version and self.count == len(self.events):
+                position = 0
+            else:
+                position = next((number for number, event_id, data, event_version, *_ in self.events
+                                 if event_version == version), None)
+                if position is None:
+                    return None
+            actions = []
+            changed = {}
+            keys = set()
+            for number, event_id, data, event_version, action, cells, delta in self.events:
+                if number <= position:
+                    continue
+                if action is not None:
+                    actions.append(action)
+                for field, i, j, value in cells:
+                    changed[field, i, j] = value
+                keys.update(key for key in delta if key not in BOARD_FIELDS)
+            cells = {}
+            for (field, i, j), value in changed.items():
+                cells.setdefault(field, []).append([i, j, value])
+            return {
+                'version': self.fields['version'],
+                'actions': actions,
+                'cells': cells,
+                'delta': dict({key: self.fields[key] for key in keys}, thinking=thinking)
+            }
+
+
+def describe_action(action):
+    if action is None:
+        return None
+    return {
+        'type': Game.Action.TYPE_TO_STRING[action.action_type],
+        'space': action.space,
+        'heading': action.heading,
+        'piece_type': action.piece_type
+    }
+
+
+store = SessionStore(session_database, lambda: adversary(), GameChannel, max_sessions, session_ttl, shared_sessions,
+                     start_ai_turn)
+
+
+# The session of the user in the cookie. A user the store doesn't know gets a new game, under a new id
+def session(response):
+    user = request.cookies.get('user')
+    current = None
+    if(user != None):
+        current = store.get(user)
+
+    if(current == None):
+        current = store.create()
+        response.set_cookie('user', current.user)
+
+    return current
+
+
 @app.route('/game/status', methods = [
     'GET',
     'POST'
@@ -30,51 +232,171 @@ def game():
 def status():
     response = make_response()
 
-    user = request.cookies.get('user')
-    if(user == None):
-        user = str(len(games))
-        response.set_cookie('user', user)
-        games.append(Game())
-        agents.append(adversary())
-
-    user = int(user)
-
-    while(len(games) < user + 1):
-        games.append(Game())
-        agents.append(adversary())
-    
-    game = games[user]
-    agent = agents[user]
-
-    if(request.method == 'POST'):
+    current = session(response)
+    game = current.game
+
+    timeout = wait_seconds(request.args.get('wait'))
+    if(request.method == 'GET' and timeout != None):
+        # long poll: hold the request until the AI's turn is over, or for at most wait seconds
+        if store.shared:
+            deadline = time.monotonic() + timeout
+            while store.refresh(current).is_thinking() and time.monotonic() < deadline:
+                time.sleep(shared_poll)
+        else:
+            with store.lock:
+                turn = current.ai_turn
+            if turn is not None:
+                wait([turn], timeout=timeout)
+
+    if(request.method == 'POST' and not current.is_thinking()):
+        with store.change(current):
+            # the human only plays White. When shared, the game has just been caught up, so it is checked again
+            action = None
+            if game.get_player_to_move() == 1 and not current.is_thinking():
+                action = apply_request(game)
+            ai_to_move = game.get_player_to_move() == -1 and not game.is_terminal()
+            # when shared, the turn is left for an ai_worker.py process to claim
+            start = ai_to_move and not current.thinking and not store.shared
+            current.thinking = current.thinking or ai_to_move
+            if action is not None:
+                current.channel.publish(game, ai_to_move, action)
+        if start:
+            start_ai_turn(current)
+
+    response.headers['Cache-Control'] = 'no-cache'
+    thinking = current.is_thinking()
+    with current.lock:
+        # the ETag names the position, so a client that already has it gets a 304 without the body
+        etag = '%d-%x-%d' % (game.history, game.get_hash(), thinking)
+        response.set_etag(etag)
+        if request.method == 'GET' and request.if_none_match.contains(etag):
+            response.status_code = 304
+            return response
+
+        body = None
+        if 'since' in request.args and request.args['since'].isdigit():
+            body = current.channel.changes_since(int(request.args['since']), thinking)
+        if body is None:
+            body = state(game, thinking)
+        response.response = json.dumps(body)
+
+    return response
+
+
+# The rule tables, which are the same for every game and never change
+@app.route('/game/rules', methods = [
+    'GET'
+])
+def game_rules():
+    response = make_response(json.dumps(rules()))
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+# Server-sent events: the whole state first, as {"event", "state"}, then one {"event", "action", "delta"} event per
+# change to the game, which the client merges into its state. A client that reconnects with Last-Event-ID gets only the
+# events it missed, or the whole state again if they are gone (see GameChannel)
+@app.route('/game/events', methods = [
+    'GET'
+])
+def events():
+    response = Response(mimetype='text/event-stream')
+    current = session(response)
+    channel = current.channel
+    last_event = request.headers.get('Last-Event-ID')
+
+    def snapshot():
+        with channel.condition:
+            event_id = channel.event_id()
+            data = json.dumps({'event': event_id, 'state': channel.fields})
+            return channel.count, 'id: %s\ndata: %s\n\n' % (event_id, data)
+
+    def stream():
+        with store.lock:
+            channel.subscribers += 1
         try:
-            if 't1' in request.json:
-                if type(request.json['t1']) is list:
-                    game.take_action(game.infer_action(tuple(request.json['t1']), tuple(request.json['t2'])))
+            position = None
+            if last_event is not None:
+                position = channel.position(last_event)
+            if position is None:
+                position, message = snapshot()
+                yield message
+            idle = 0
+            while True:
+                # when shared, changes made by other processes only reach the channel when the session is refreshed
+                updates = channel.events_after(position, shared_poll if store.shared else heartbeat)
+                if updates is None:
+                    position, message = snapshot()
+                    yield message
+                elif not updates:
+                    idle += shared_poll if store.shared else heartbeat
+                    if store.shared:
+                        store.refresh(current)
+                    if idle >= heartbeat:
+                        idle = 0
+                        yield ': heartbeat\n\n'
                 else:
-                    #create
-                    game.take_action(Game.Action(Game.Action.TYPE_PLACE, tuple(request.json['t2']), None, request.json['t1']))
-                    pass
+                    idle = 0
+                    position += len(updates)
+                for event_id, data in updates or ():
+                    yield 'id: %s\ndata: %s\n\n' % (event_id, data)
+        finally:
+            with store.lock:
+                channel.subscribers -= 1
+
+    response.response = stream()
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# The seconds of ?wait=, at most max_wait. None if there is none, or it isn't a finite number
+def wait_seconds(value):
+    if(value == None):
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(seconds):
+        return None
+    return min(max(seconds, 0), max_wait)
+
+
+# Takes the action the request asks for, returning it, or None if it wasn't legal
+def apply_request(game):
+    try:
+        if 't1' in request.json:
+            if type(request.json['t1']) is list:
+                action = game.infer_action(tuple(request.json['t1']), tuple(request.json['t2']))
             else:
-                #research
-                if 'research' in request.json and request.json['research'] != None:
-                    game.take_action(Game.Action(Game.Action.TYPE_RESEARCH, None, None, request.json['research']))
-                    while game.get_player_to_move() == -1:
-                        game.take_action(agent.decide_action(game))
-                elif 'economy_phase' in request.json:
-                    game.take_action(Game.Action(Game.Action.TYPE_ECONOMY, None, None, None))
-                else:
-                    game.take_action(Game.Action(Game.Action.TYPE_END_TURN, None, None, None))
-                    while game.get_player_to_move() == -1:
-                        game.take_action(agent.decide_action(game))
-        except Exception as e:
-            print(e)
-        
-    response.response = json.dumps({
-        'max_health': game._M_MAP,
-        'attack': game._A_MAP,
-        'retaliation': game._R_MAP,
-        'cost': game._C_MAP,
+                #create
+                action = Game.Action(Game.Action.TYPE_PLACE, tuple(request.json['t2']), None, request.json['t1'])
+        else:
+            #research
+            if 'research' in request.json and request.json['research'] != None:
+                action = Game.Action(Game.Action.TYPE_RESEARCH, None, None, request.json['research'])
+            elif 'economy_phase' in request.json:
+                action = Game.Action(Game.Action.TYPE_ECONOMY, None, None, None)
+            else:
+                action = Game.Action(Game.Action.TYPE_END_TURN, None, None, None)
+        # the session store saves games as action ids, so an action without one (to_id raises) could never be saved
+        action.to_id()
+        game.take_action(action)
+        return action
+    except Exception as e:
+        print(e)
+        return None
+
+
+# The board fields of state(), which ?since= sends cell by cell
+BOARD_FIELDS = ('attack_ready', 'bless', 'cities', 'move_ready', 'piece_health', 'pieces')
+
+
+# What the client needs to draw the game. The rule tables never change, so they are served by /game/rules instead.
+# version is the number of actions played so far
+def state(game, thinking):
+    return {
         'attack_ready': game.get_attack_ready(),
         'black_money': game.get_black_money(),
         'black_research': game.get_black_research(),
@@ -86,7 +408,16 @@ def status():
         'pieces': game.get_pieces(),
         'player_to_move': game.get_player_to_move(),
         'white_money': game.get_white_money(),
-        'white_research': game.get_white_research()
-    })
-    
-    return response
\ No newline at end of file
+        'white_research': game.get_white_research(),
+        'version': game.history,
+        'thinking': thinking
+    }
+
+
+def rules():
+    return {
+        'max_health': Game._M_MAP,
+        'attack': Game._A_MAP,
+        'retaliation': Game._R_MAP,
+        'cost': Game._C_MAP
+    }
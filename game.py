@@ -1,3 +1,60 @@
+import random
+from array import array
+
+# Layout of Game._board. Every channel holds one value per square, indexed by row * 8 + col
+_PIECES = 0
+_HEALTH = 64
+_MOVE_READY = 128
+_ATTACK_READY = 192
+_BLESS = 256
+_CITIES = 320
+_BOARD_SIZE = 384
+
+# Whether each square has a city on it. Cities never appear or disappear, only change hands
+_IS_CITY = (
+    True, False, True, False, False, False, False, True,
+    False, False, False, False, True, False, False, False,
+    True, False, True, False, False, False, False, False,
+    False, False, False, False, False, False, True, False,
+    False, True, False, False, False, False, False, False,
+    False, False, False, False, False, True, False, True,
+    False, False, False, True, False, False, False, False,
+    True, False, False, False, False, True, False, True,
+)
+
+_NO_READINESS = array("b", bytes(_BLESS - _MOVE_READY))
+
+# Slices of Game._board: every channel of one square, and both readiness channels
+_SQUARE_CELLS = tuple(slice(square, _BOARD_SIZE, 64) for square in range(64))
+_READINESS_CELLS = slice(_MOVE_READY, _BLESS)
+
+# Marks an undo record from apply_turn, which saves the whole board rather than a few squares
+_WHOLE_BOARD = object()
+
+_CITY_SQUARES = tuple(square for square in range(64) if _IS_CITY[square])
+
+# Random 64 bit keys for Zobrist hashing. _ZOBRIST[cell][value] is the key for that value in that cell of Game._board.
+# Every value stored on the board is between -8 and 7, so negative values just index from the end of each list. Empty
+# cells (value 0) have a key of 0 so that they don't need to be hashed at all. The generator is seeded so every process
+# agrees on the keys
+_zobrist_random = random.Random(20230101)
+_ZOBRIST = tuple([0] + [_zobrist_random.getrandbits(64) for _ in range(15)] for _ in range(_BOARD_SIZE))
+_ZOBRIST_WHITE_RESEARCH = tuple(_zobrist_random.getrandbits(64) for _ in range(256))
+_ZOBRIST_BLACK_RESEARCH = tuple(_zobrist_random.getrandbits(64) for _ in range(256))
+_ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+_ZOBRIST_ECONOMY_PHASE = _zobrist_random.getrandbits(64)
+_ZOBRIST_BLACK_MONEY = _zobrist_random.getrandbits(64)
+del _zobrist_random
+
+
+# Money has no upper limit, so rather than having a key per amount it is scrambled into 64 bits (SplitMix64)
+def _hash_money(money):
+    money = (money + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    money = ((money ^ (money >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    money = ((money ^ (money >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return money ^ (money >> 31)
+
+
 class Game:
     class Action:
         TYPE_MOVE = 1  # Moves the piece at space in the direction of heading
@@ -18,11 +75,168 @@ class Game:
             "end": TYPE_END_TURN,
         }
 
+        TYPE_TO_STRING = {action_type: string for string, action_type in STRING_TO_TYPE.items()}
+
+        # The 8 directions a piece can face, clockwise from North
+        HEADINGS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+        HEADING_INDEX = {heading: index for index, heading in enumerate(HEADINGS)}
+
+        # Every action has a dense integer id, and these are the first id of each action type. Moves and attacks take
+        # 64 squares x 8 headings, captures one per square, research one per piece type, places 64 squares x 7 piece
+        # types, and economy and end turn one each
+        MOVE_BASE = 0
+        ATTACK_BASE = MOVE_BASE + 64 * 8
+        CAPTURE_BASE = ATTACK_BASE + 64 * 8
+        RESEARCH_BASE = CAPTURE_BASE + 64
+        ECONOMY_ID = RESEARCH_BASE + 7
+        PLACE_BASE = ECONOMY_ID + 1
+        END_TURN_ID = PLACE_BASE + 64 * 7
+        NUM_IDS = END_TURN_ID + 1
+
+        # Filled in below the Game class with one shared instance per id
+        _TABLE = ()
+
+        # Actions are immutable values: two actions with the same parameters are equal and hash the same, whether or
+        # not they are the same object
+        __slots__ = ("action_type", "space", "heading", "piece_type", "_id", "_key")
+
         def __init__(self, action_type, space=None, heading=None, piece_type=None):
-            self.action_type = action_type
-            self.space = space
-            self.heading = heading
-            self.piece_type = piece_type
+            # Spaces, headings and piece types are stored in their canonical form (tuples and piece numbers) whenever
+            # they are valid, and parameters the action type doesn't use are dropped
+            if action_type in (Game.Action.TYPE_MOVE, Game.Action.TYPE_ATTACK):
+                space = self._canonical_space(space)
+                heading = self._canonical_heading(heading)
+                piece_type = None
+            elif action_type == Game.Action.TYPE_CAPTURE:
+                space = self._canonical_space(space)
+                heading = piece_type = None
+            elif action_type == Game.Action.TYPE_RESEARCH:
+                piece_type = self._canonical_piece_type(piece_type)
+                space = heading = None
+            elif action_type == Game.Action.TYPE_PLACE:
+                space = self._canonical_space(space)
+                piece_type = self._canonical_piece_type(piece_type)
+                heading = None
+            elif action_type in (Game.Action.TYPE_ECONOMY, Game.Action.TYPE_END_TURN):
+                space = heading = piece_type = None
+
+            action_id = Game.Action._compute_id(action_type, space, heading, piece_type)
+
+            object.__setattr__(self, "action_type", action_type)
+            object.__setattr__(self, "space", space)
+            object.__setattr__(self, "heading", heading)
+            object.__setattr__(self, "piece_type", piece_type)
+            object.__setattr__(self, "_id", action_id)
+            # Actions that can't be played anywhere (like a heading of (0, 0)) have no id, so they compare by parameters
+            if action_id is None:
+                object.__setattr__(self, "_key", (action_type, space, heading, piece_type))
+            else:
+                object.__setattr__(self, "_key", action_id)
+
+        def __setattr__(self, name, value):
+            raise AttributeError("Actions are immutable")
+
+        def __delattr__(self, name):
+            raise AttributeError("Actions are immutable")
+
+        def __eq__(self, other):
+            if not isinstance(other, Game.Action):
+                return NotImplemented
+            return self._key == other._key
+
+        def __hash__(self):
+            return hash(self._key)
+
+        def __repr__(self):
+            parameters = [self.TYPE_TO_STRING.get(self.action_type, str(self.action_type))]
+            for parameter in (self.space, self.heading, self.piece_type):
+                if parameter is not None:
+                    parameters.append(str(parameter))
+            return "Action(" + ", ".join(parameters) + ")"
+
+        # Unpickling gives back the shared instance for actions that have an id
+        def __reduce__(self):
+            if self._id is not None:
+                return Game.Action.from_id, (self._id,)
+            return Game.Action, (self.action_type, self.space, self.heading, self.piece_type)
+
+        def to_id(self):
+            if self._id is None:
+                raise Exception("Action has no id: " + repr(self))
+            return self._id
+
+        @staticmethod
+        def from_id(action_id):
+            return Game.Action._TABLE[action_id]
+
+        # The same action on the board turned 180 degrees (see Game.mirror): its square is turned and its heading
+        # reversed
+        def mirror(self):
+            return Game.Action._TABLE[_MIRROR_IDS[self.to_id()]]
+
+        @staticmethod
+        def _canonical_space(space):
+            if isinstance(space, list):
+                space = tuple(space)
+            if isinstance(space, str):
+                try:
+                    return Game._parse_space(space)
+                except Exception:
+                    return space
+            return space
+
+        @staticmethod
+        def _canonical_heading(heading):
+            if isinstance(heading, list):
+                heading = tuple(heading)
+            if isinstance(heading, str):
+                parsed = Game._parse_heading(heading)
+                if parsed in Game.Action.HEADING_INDEX:
+                    return parsed
+            return heading
+
+        @staticmethod
+        def _canonical_piece_type(piece_type):
+            if isinstance(piece_type, str) and piece_type in Game._NAME_TO_NUMBER:
+                return Game._NAME_TO_NUMBER[piece_type]
+            return piece_type
+
+        @staticmethod
+        def _square_of(space):
+            if isinstance(space, tuple) and len(space) == 2:
+                row, col = space
+                if type(row) is int and type(col) is int and 0 <= row <= 7 and 0 <= col <= 7:
+                    return row * 8 + col
+            return None
+
+        @staticmethod
+        def _compute_id(action_type, space, heading, piece_type):
+            Action = Game.Action
+            if action_type == Action.TYPE_ECONOMY:
+                return Action.ECONOMY_ID
+            if action_type == Action.TYPE_END_TURN:
+                return Action.END_TURN_ID
+            if action_type == Action.TYPE_RESEARCH:
+                if type(piece_type) is int and 1 <= piece_type <= 7:
+                    return Action.RESEARCH_BASE + piece_type - 1
+                return None
+
+            square = Action._square_of(space)
+            if square is None:
+                return None
+            if action_type == Action.TYPE_CAPTURE:
+                return Action.CAPTURE_BASE + square
+            if action_type == Action.TYPE_PLACE:
+                if type(piece_type) is int and 1 <= piece_type <= 7:
+                    return Action.PLACE_BASE + square * 7 + piece_type - 1
+                return None
+            if action_type in (Action.TYPE_MOVE, Action.TYPE_ATTACK):
+                heading_index = Action.HEADING_INDEX.get(heading) if isinstance(heading, tuple) else None
+                if heading_index is None:
+                    return None
+                base = Action.MOVE_BASE if action_type == Action.TYPE_MOVE else Action.ATTACK_BASE
+                return base + square * 8 + heading_index
+            return None
 
     ### RULES ###
     # The game is played on an 8x8 board, with 14 cities spread throughout.
@@ -104,136 +318,92 @@ class Game:
     #   - The Top Right corner of the map is (0,7) or "H8"
     #   - The Bottom Left corner of the map is (7,0) or "A1"
     #   - The Bottom Right corner of the map is (7,7) or "H1"
+    # - Internally the whole board lives in one flat array of signed bytes (self._board) instead of one nested list per
+    #   property. Each property gets a channel of 64 cells, and the square (row, col) sits at row * 8 + col within it,
+    #   so the value of a property at a square is self._board[<CHANNEL> + row * 8 + col]. Copying a position is then a
+    #   single buffer copy plus a handful of scalars.
+    # - Which squares hold a city never changes, so that is a constant (_IS_CITY); the board only stores the owner.
+    # - Research is kept as a bitmask per player, where bit n is set once piece type n has been researched.
+
+    _NAME_TO_NUMBER = {
+        "basic": 1,
+        "runner": 2,
+        "defender": 3,
+        "swordsman": 4,
+        "archer": 5,
+        "support": 6,
+        "berserker": 7
+    }
+    _NUMBER_TO_NAME = {
+        1: "basic",
+        2: "runner",
+        3: "defender",
+        4: "swordsman",
+        5: "archer",
+        6: "support",
+        7: "berserker"
+    }
+    _M_MAP = {
+        1: 2,
+        2: 1,
+        3: 3,
+        4: 3,
+        5: 2,
+        6: 2,
+        7: 3
+    }
+    _A_MAP = {
+        1: 1,
+        2: 1,
+        3: 1,
+        4: 2,
+        5: 1,
+        6: 0,
+        7: 2
+    }
+    _R_MAP = {
+        1: 1,
+        2: 0,
+        3: 3,
+        4: 1,
+        5: 0,
+        6: 1,
+        7: 0
+    }
+    _C_MAP = {
+        1: 1,
+        2: 1,
+        3: 2,
+        4: 3,
+        5: 3,
+        6: 2,
+        7: 4
+    }
+
+    # The rule tables above are shared by every Game, so only these need to be copied
+    __slots__ = ("_board", "_player_to_move", "_economy_phase", "_white_money", "_black_money", "_white_research",
+                 "_black_research", "_white_cities", "_black_cities", "_white_pieces", "_black_pieces",
+                 "_white_material", "_black_material", "_board_key", "_piece_actions", "_history", "_history_length",
+                 "_search_statistics")
 
     def __init__(self):
-        self._NAME_TO_NUMBER = {
-            "basic": 1,
-            "runner": 2,
-            "defender": 3,
-            "swordsman": 4,
-            "archer": 5,
-            "support": 6,
-            "berserker": 7
-        }
-        self._NUMBER_TO_NAME = {
-            1: "basic",
-            2: "runner",
-            3: "defender",
-            4: "swordsman",
-            5: "archer",
-            6: "support",
-            7: "berserker"
-        }
-        self._M_MAP = {
-            1: 2,
-            2: 1,
-            3: 3,
-            4: 3,
-            5: 2,
-            6: 2,
-            7: 3
-        }
-        self._A_MAP = {
-            1: 1,
-            2: 1,
-            3: 1,
-            4: 2,
-            5: 1,
-            6: 0,
-            7: 2
-        }
-        self._R_MAP = {
-            1: 1,
-            2: 0,
-            3: 3,
-            4: 1,
-            5: 0,
-            6: 1,
-            7: 0
-        }
-        self._C_MAP = {
-            1: 1,
-            2: 1,
-            3: 2,
-            4: 3,
-            5: 3,
-            6: 2,
-            7: 4
-        }
+        # Starts out empty: no pieces, no readiness, nobody blessed and every city neutral
+        self._board = array("b", bytes(_BOARD_SIZE))
 
-        # a space without a city is represented by None.
-        # a Black city is -1, a White city is 1, and a neutral city is 0
-        self._cities = [
-            [-1, None, 0, None, None, None, None, 0],
-            [None, None, None, None, 0, None, None, None],
-            [0, None, 0, None, None, None, None, None],
-            [None, None, None, None, None, None, 0, None],
-            [None, 0, None, None, None, None, None, None],
-            [None, None, None, None, None, 0, None, 0],
-            [None, None, None, 0, None, None, None, None],
-            [0, None, None, None, None, 0, None, 1],
-        ]
-
-        # a Black piece is a negative number, a White piece is a positive number, and the magnitude tells you what kind
-        # of piece it is. 0 means the space is unoccupied.
-        self._pieces = [
-            [-1, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 1]
-        ]
-
-        # The Max health of a piece can be determined by its type in self.pieces. This tracks each piece's current
-        # health
-        self._piece_health = [
-            [2, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 2]
-        ]
+        # At the beginning, the top left corner is controlled by Black and the bottom right by White
+        self._board[_CITIES + 0] = -1
+        self._board[_CITIES + 63] = 1
+
+        # Each player starts with a Basic in their corner
+        self._board[_PIECES + 0] = -1
+        self._board[_HEALTH + 0] = 2
+        self._board[_PIECES + 63] = 1
+        self._board[_HEALTH + 63] = 2
 
         # White plays first and their starting piece has one point of move and one point of attack readiness. Black will
         # get readiness at the start of their turn
-        self._move_ready = [
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 1]
-        ]
-        self._attack_ready = [
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 1]
-        ]
-
-        # Nobody starts blessed
-        self._bless = [
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0, 0]
-        ]
+        self._board[_MOVE_READY + 63] = 1
+        self._board[_ATTACK_READY + 63] = 1
 
         # player_to_move = 1 for white or -1 for black
         self._player_to_move = 1
@@ -244,42 +414,295 @@ class Game:
         self._black_money = 1
 
         # There is no unit type 0. Both players start only able to build units of type 1 (Basic)
-        self._white_research = {
-            1: True,
-            2: False,
-            3: False,
-            4: False,
-            5: False,
-            6: False,
-            7: False,
-        }
-        self._black_research = {
-            1: True,
-            2: False,
-            3: False,
-            4: False,
-            5: False,
-            6: False,
-            7: False,
-        }
+        self._white_research = 1 << 1
+        self._black_research = 1 << 1
+
+        # Running totals of what each player controls, kept up to date as the board changes so nothing has to scan it.
+        # Material is the total cost of a player's pieces on the board
+        self._white_cities = 1
+        self._black_cities = 1
+        self._white_pieces = 1
+        self._black_pieces = 1
+        self._white_material = self._C_MAP[1]
+        self._black_material = self._C_MAP[1]
+
+        # The Zobrist key of everything on the board. It is updated as actions change the board, and get_hash() folds
+        # the scalar state into it
+        self._board_key = self._compute_board_key()
+
+        # The actions of the piece on each square, filled in as get_possible_actions needs them. An entry is reset to
+        # None whenever anything it depends on changes, and the whole list is reset when readiness is swept
+        self._piece_actions = [None] * 64
+
+        # Every action played so far, as a linked list from the latest: (action, (previous action, (...))). Copies of
+        # the game share the older part, so cloning and playing an action never copy the whole history
+        self._history = None
+        self._history_length = 0
+
+        # What the search found at each position of the game, for training: a tuple with one (player to move, action
+        # ids, visit counts) entry per position, filled in by store_search_statistics
+        self._search_statistics = ()
+
+    # Returns an independent copy of this game. Only the mutable state is copied: the board is one buffer copy and the
+    # rest are immutable scalars, so this is much cheaper than a generic deepcopy
+    def clone(self):
+        other = object.__new__(self.__class__)
+        other._board = self._board[:]
+        other._player_to_move = self._player_to_move
+        other._economy_phase = self._economy_phase
+        other._white_money = self._white_money
+        other._black_money = self._black_money
+        other._white_research = self._white_research
+        other._black_research = self._black_research
+        other._white_cities = self._white_cities
+        other._black_cities = self._black_cities
+        other._white_pieces = self._white_pieces
+        other._black_pieces = self._black_pieces
+        other._white_material = self._white_material
+        other._black_material = self._black_material
+        other._board_key = self._board_key
+        other._piece_actions = self._piece_actions[:]
+        other._history = self._history
+        other._history_length = self._history_length
+        other._search_statistics = self._search_statistics
+        return other
+
+    # The same position turned 180 degrees with the colours swapped, so each player has the other's pieces, cities,
+    # money, research and turn. The city layout maps onto itself this way, so the rules play out the same: an action
+    # is legal here exactly when action.mirror() is legal in the mirrored game, and rewards are negated
+    def mirror(self):
+        board = self._board
+        mirrored = array("b", bytes(_BOARD_SIZE))
+        for channel in (_PIECES, _HEALTH, _MOVE_READY, _ATTACK_READY, _BLESS, _CITIES):
+            cells = board[channel:channel + 64]
+            cells.reverse()
+            if channel == _PIECES or channel == _CITIES:
+                cells = array("b", [-value for value in cells])
+            mirrored[channel:channel + 64] = cells
+
+        other = object.__new__(self.__class__)
+        other._board = mirrored
+        other._player_to_move = -self._player_to_move
+        other._economy_phase = self._economy_phase
+        other._white_money = self._black_money
+        other._black_money = self._white_money
+        other._white_research = self._black_research
+        other._black_research = self._white_research
+        other._white_cities = self._black_cities
+        other._black_cities = self._white_cities
+        other._white_pieces = self._black_pieces
+        other._black_pieces = self._white_pieces
+        other._white_material = self._black_material
+        other._black_material = self._white_material
+        other._board_key = other._compute_board_key()
+        other._piece_actions = [None] * 64
+        # the mirrored position can't be reached from the starting position by mirrored actions, so it has no history
+        other._history = None
+        other._history_length = 0
+        other._search_statistics = ()
+        return other
+
+    # Positions come in mirrored pairs (see mirror) and the canonical one of each pair has White to move. Returns the
+    # canonical position and the sign to multiply its rewards and values by to get this position's. With White to move
+    # that is this game itself, not a copy
+    def canonical(self):
+        if self._player_to_move == 1:
+            return self, 1
+        return self.mirror(), -1
+
+    # get_hash() of the canonical position, so a position and its mirror image have the same key
+    def get_canonical_hash(self):
+        return self.canonical()[0].get_hash()
+
+    # The input planes for a neural network, each one value per square. They describe the canonical position, so the
+    # player to move is always "own":
+    #   0-6    own pieces, one plane per piece type
+    #   7-13   opponent pieces, one plane per piece type
+    #   14-17  health, move readiness, attack readiness and blessed
+    #   18-20  own, opponent and neutral cities
+    #   21     1 everywhere in the Economy Phase
+    #   22-23  own and opponent money, divided by 10
+    #   24-30  1 everywhere for each piece type the player to move has researched
+    #   31-37  the same for the opponent
+    ENCODING_PLANES = 38
+
+    # Writes the planes above into out, which must be a float array shaped (ENCODING_PLANES, 64), such as a row of a
+    # preallocated numpy batch. Nothing is allocated apart from the mirrored game when Black is to move
+    def encode(self, out):
+        game = self.canonical()[0]
+        board = game._board
+        out[:] = 0
+
+        for square in range(64):
+            piece = board[_PIECES + square]
+            if piece > 0:
+                out[piece - 1, square] = 1
+            elif piece < 0:
+                out[6 - piece, square] = 1
+
+        out[14] = board[_HEALTH:_HEALTH + 64]
+        out[15] = board[_MOVE_READY:_MOVE_READY + 64]
+        out[16] = board[_ATTACK_READY:_ATTACK_READY + 64]
+        out[17] = board[_BLESS:_BLESS + 64]
+
+        for square in _CITY_SQUARES:
+            owner = board[_CITIES + square]
+            if owner == 1:
+                out[18, square] = 1
+            elif owner == -1:
+                out[19, square] = 1
+            else:
+                out[20, square] = 1
+
+        if game._economy_phase:
+            out[21] = 1
+        out[22] = game._white_money / 10
+        out[23] = game._black_money / 10
+        for piece_type in range(1, 8):
+            if game._white_research >> piece_type & 1:
+                out[23 + piece_type] = 1
+            if game._black_research >> piece_type & 1:
+                out[30 + piece_type] = 1
+
+    # The number of actions played so far
+    @property
+    def history(self):
+        return self._history_length
+
+    # Every action played so far, oldest first
+    def get_history(self):
+        actions = []
+        node = self._history
+        while node is not None:
+            actions.append(node[0])
+            node = node[1]
+        actions.reverse()
+        return actions
+
+    # Records what a search of the current position found, given its root (an ai.Node): the ids of the actions it
+    # visited and how many times it visited each. It has to be called for every position of the game in order, before
+    # the action is played, so that entry i is for the position after i actions
+    def store_search_statistics(self, root):
+        if len(self._search_statistics) != self._history_length:
+            raise Exception("Search statistics must be stored for every position, in order")
+        action_ids = array("H")
+        visit_counts = array("I")
+        for action, visit_count in zip(root.actions, root.child_visits):
+            if visit_count > 0:
+                action_ids.append(action.to_id())
+                visit_counts.append(int(visit_count))
+        self._search_statistics += ((self._player_to_move, action_ids, visit_counts),)
+
+    # Writes the encode() planes of the position after state_index actions into out. Only the actions are kept, so the
+    # position is rebuilt by replaying the game from the start. -1 is the current position
+    def make_image(self, state_index, out):
+        self.make_images((state_index,), (out,))
+
+    # make_image for several positions with a single replay: the planes for state_indices[i] go into outs[i]
+    def make_images(self, state_indices, outs):
+        wanted = {}
+        for state_index, out in zip(state_indices, outs):
+            if state_index < 0:
+                state_index += self._history_length + 1
+            if not 0 <= state_index <= self._history_length:
+                raise Exception("No position " + str(state_index) + " in this game")
+            if state_index == self._history_length:
+                self.encode(out)
+            else:
+                wanted.setdefault(state_index, []).append(out)
+        if not wanted:
+            return
+
+        for ply, game in enumerate(self.replay()):
+            for out in wanted.get(ply, ()):
+                game.encode(out)
+            if ply == max(wanted):
+                break
+
+    # Plays the game again from the start, yielding the position after 0, 1, 2 ... actions. It is the same Game object
+    # every time, so anything kept from it has to be copied before the next one
+    def replay(self):
+        game = Game()
+        yield game
+        for action in self.get_history():
+            game.take_action(action)
+            yield game
+
+    # The canonical position (see canonical) as raw data, which is everything encode() uses: the board as bytes in the
+    # layout of _board, and a tuple of the Economy Phase flag, own money, opponent money, own research and opponent
+    # research (as bit masks, bit n for piece type n)
+    def get_canonical_state(self):
+        game = self.canonical()[0]
+        return game._board.tobytes(), (game._economy_phase, game._white_money, game._black_money,
+                                       game._white_research, game._black_research)
+
+    # The training targets for the position after state_index actions. Returns the result of the game for the player
+    # to move there, between 0 and 1 (0.5 if the game didn't finish), and writes the search's visit distribution into
+    # policy_out, a float array of Action.NUM_IDS. Like encode(), the policy is in the canonical orientation
+    def make_target(self, state_index, policy_out):
+        player, action_ids, visit_counts = self._search_statistics[state_index]
+        value = (self.get_reward() * player + 1) / 2
+        total = sum(visit_counts)
+        policy_out[:] = 0
+        for action_id, visit_count in zip(action_ids, visit_counts):
+            if player == -1:
+                action_id = _MIRROR_IDS[action_id]
+            policy_out[action_id] = visit_count / total
+        return value, policy_out
+
+    # The history is pickled as a flat tuple of actions, because a long linked list is too deeply nested to pickle
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["_history"] = tuple(self.get_history())
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._history = None
+        for action in state["_history"]:
+            self._history = (action, self._history)
+
+    # A Game never shares its board with another Game, so both kinds of copy are a clone
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    # Rebuilds the 8x8 nested list view of one channel of the board
+    def _channel_rows(self, channel):
+        board = self._board
+        return [board[channel + row * 8:channel + row * 8 + 8].tolist() for row in range(8)]
+
+    @staticmethod
+    def _research_dict(research):
+        return {piece_type: bool(research >> piece_type & 1) for piece_type in range(1, 8)}
 
     def get_cities(self):
-        return self._cities.copy()
+        # a space without a city is represented by None.
+        # a Black city is -1, a White city is 1, and a neutral city is 0
+        cities = self._channel_rows(_CITIES)
+        for row in range(8):
+            for col in range(8):
+                if not _IS_CITY[row * 8 + col]:
+                    cities[row][col] = None
+        return cities
 
     def get_pieces(self):
-        return self._pieces.copy()
+        return self._channel_rows(_PIECES)
 
     def get_piece_health(self):
-        return self._piece_health.copy()
+        return self._channel_rows(_HEALTH)
 
     def get_move_ready(self):
-        return self._move_ready.copy()
+        return self._channel_rows(_MOVE_READY)
 
     def get_attack_ready(self):
-        return self._attack_ready.copy()
+        return self._channel_rows(_ATTACK_READY)
 
     def get_bless(self):
-        return self._bless.copy()
+        return self._channel_rows(_BLESS)
 
     def get_white_money(self):
         return self._white_money
@@ -288,10 +711,10 @@ class Game:
         return self._black_money
 
     def get_white_research(self):
-        return self._white_research.copy()
+        return self._research_dict(self._white_research)
 
     def get_black_research(self):
-        return self._black_research.copy()
+        return self._research_dict(self._black_research)
 
     def get_player_to_move(self):
         return self._player_to_move
@@ -299,6 +722,67 @@ class Game:
     def get_economy_phase(self):
         return self._economy_phase
 
+    # City, piece and material counts for both players, without copying any boards
+    def get_summary(self):
+        return {
+            "white_cities": self._white_cities,
+            "black_cities": self._black_cities,
+            "neutral_cities": len(_CITY_SQUARES) - self._white_cities - self._black_cities,
+            "white_pieces": self._white_pieces,
+            "black_pieces": self._black_pieces,
+            "white_material": self._white_material,
+            "black_material": self._black_material,
+            "white_money": self._white_money,
+            "black_money": self._black_money,
+            "white_researched": bin(self._white_research).count("1"),
+            "black_researched": bin(self._black_research).count("1"),
+            "player_to_move": self._player_to_move,
+            "economy_phase": self._economy_phase,
+            "reward": self.get_reward(),
+        }
+
+    # A 64 bit Zobrist hash of the whole position: the board, money, research, side to move and phase. Equal positions
+    # always have equal hashes, however they were reached
+    def get_hash(self):
+        key = (self._board_key ^ _ZOBRIST_WHITE_RESEARCH[self._white_research] ^
+               _ZOBRIST_BLACK_RESEARCH[self._black_research] ^ _hash_money(self._white_money) ^
+               _hash_money(self._black_money ^ _ZOBRIST_BLACK_MONEY))
+        if self._player_to_move == -1:
+            key ^= _ZOBRIST_BLACK_TO_MOVE
+        if self._economy_phase:
+            key ^= _ZOBRIST_ECONOMY_PHASE
+        return key
+
+    # Works out the board part of the Zobrist key from scratch
+    def _compute_board_key(self):
+        board = self._board
+        key = 0
+        for cell in range(_BOARD_SIZE):
+            value = board[cell]
+            if value:
+                key ^= _ZOBRIST[cell][value]
+        return key
+
+    # The Zobrist key of every channel of one square
+    def _square_key(self, square):
+        board = self._board
+        key = 0
+        for cell in range(square, _BOARD_SIZE, 64):
+            value = board[cell]
+            if value:
+                key ^= _ZOBRIST[cell][value]
+        return key
+
+    # The Zobrist key of both readiness channels
+    def _readiness_key(self):
+        board = self._board
+        key = 0
+        for cell in range(_MOVE_READY, _BLESS):
+            value = board[cell]
+            if value:
+                key ^= _ZOBRIST[cell][value]
+        return key
+
     def stringify_board(self):
         """
         ┏━━━━━┳━━━━━┳━━━━━┳━━━━━┳━━━━━┳━━━━━┳━━━━━┳━━━━━┓
@@ -324,49 +808,53 @@ class Game:
         WHITE_PIECES = " BRDSAUZ"
         BLACK_PIECES = " brdsauz"
 
+        board = self._board
+
         def _stringify_tile(row, col):
             tile_out = ""
+            square = row * 8 + col
 
             # Letter for piece type
-            piece_type = self._pieces[row][col]
+            piece_type = board[_PIECES + square]
             if piece_type < 0:
                 tile_out += BLACK_PIECES[-piece_type]
             else:
                 tile_out += WHITE_PIECES[piece_type]
 
             # Number for piece health
-            piece_health = self._piece_health[row][col]
+            piece_health = board[_HEALTH + square]
             if piece_health == 0:
                 tile_out += " "
             else:
-                tile_out += str(self._piece_health[row][col])
+                tile_out += str(piece_health)
 
             # Symbol for piece readiness
-            if self._move_ready[row][col] == 2:
+            if board[_MOVE_READY + square] == 2:
                 readiness = "‼"
-            elif self._move_ready[row][col] == 1:
+            elif board[_MOVE_READY + square] == 1:
                 readiness = "!"
-            elif self._attack_ready[row][col] == 1:
+            elif board[_ATTACK_READY + square] == 1:
                 readiness = "."
             else:
                 readiness = " "
 
             # If a piece is blessed, it will have a * next to its health, and readiness is after that
-            if self._bless[row][col]:
+            if board[_BLESS + square]:
                 tile_out += "*" + readiness
             else:
                 tile_out += readiness + " "
 
             # Symbol for city control
-            match self._cities[row][col]:
-                case 0:
-                    tile_out += "◈"
-                case -1:
-                    tile_out += "■"
-                case 1:
-                    tile_out += "□"
-                case _:
-                    tile_out += " "
+            if not _IS_CITY[square]:
+                tile_out += " "
+            else:
+                match board[_CITIES + square]:
+                    case 0:
+                        tile_out += "◈"
+                    case -1:
+                        tile_out += "■"
+                    case 1:
+                        tile_out += "□"
 
             return tile_out
 
@@ -394,15 +882,15 @@ class Game:
         output += "WHITE:\n"
         output += "Money: " + str(self._white_money) + "\n"
         output += "Research:\n"
-        for tech in self._white_research:
-            if self._white_research[tech]:
+        for tech in range(1, 8):
+            if self._white_research >> tech & 1:
                 output += self._NUMBER_TO_NAME[tech] + "\n"
         output += "----------------\n"
         output += "BLACK:\n"
         output += "Money: " + str(self._black_money) + "\n"
         output += "Research:\n"
-        for tech in self._black_research:
-            if self._black_research[tech]:
+        for tech in range(1, 8):
+            if self._black_research >> tech & 1:
                 output += self._NUMBER_TO_NAME[tech] + "\n"
         output += "----------------\n"
 
@@ -413,106 +901,163 @@ class Game:
 
     # Returns a list of objects of type Action
     def get_possible_actions(self):
-        if self._player_to_move == 1:
+        board = self._board
+        player = self._player_to_move
+        piece_actions = self._piece_actions
+
+        output = []
+        for square in range(64):
+            if board[_PIECES + square] * player > 0:
+                square_actions = piece_actions[square]
+                if square_actions is None:
+                    square_actions = piece_actions[square] = self._get_piece_actions_at(square)
+                output.extend(square_actions)  # Move, Attack, Capture
+
+        output.extend(self._get_phase_actions())
+        return output
+
+    # The same as get_possible_actions, but works out every piece's actions from scratch instead of using the cache
+    def _get_possible_actions_uncached(self):
+        board = self._board
+        player = self._player_to_move
+
+        output = []
+        for square in range(64):
+            if board[_PIECES + square] * player > 0:
+                output.extend(self._get_piece_actions_at(square))  # Move, Attack, Capture
+
+        output.extend(self._get_phase_actions())
+        return output
+
+    # Place, Research, Economy and End Turn
+    def _get_phase_actions(self):
+        board = self._board
+        player = self._player_to_move
+        actions = Game.Action._TABLE
+
+        if player == 1:
             money = self._white_money
         else:
             money = self._black_money
 
-        if self._player_to_move == 1:
+        if player == 1:
             tech = self._white_research
         else:
             tech = self._black_research
 
         output = []
-        for row in range(8):
-            for col in range(8):
-                if self._pieces[row][col] * self._player_to_move > 0:
-                    output.extend(self._get_piece_actions_at(row, col))  # Move, Attack, Capture
 
         # Place
         if self._economy_phase:
-            for row in range(8):
-                for col in range(8):
-                    if self._cities[row][col] == self._player_to_move and self._pieces[row][col] == 0:
-                        # in each empty city the current player owns
-                        for piece_type in range(1, 8):
-                            # for each kind of piece
-                            if tech[piece_type] and money > self._C_MAP[piece_type]:
-                                output.append(Game.Action(Game.Action.TYPE_PLACE, (row, col), None, piece_type))
+            for square in _CITY_SQUARES:
+                if board[_CITIES + square] == player and board[_PIECES + square] == 0:
+                    # in each empty city the current player owns
+                    for piece_type in range(1, 8):
+                        # for each kind of piece
+                        if tech >> piece_type & 1 and money > self._C_MAP[piece_type]:
+                            output.append(actions[Game.Action.PLACE_BASE + square * 7 + piece_type - 1])
 
         # Research
         if not self._economy_phase:
             for piece_type in range(1, 8):
-                if not tech[piece_type]:
-                    output.append(Game.Action(Game.Action.TYPE_RESEARCH, None, None, piece_type))
+                if not tech >> piece_type & 1:
+                    output.append(actions[Game.Action.RESEARCH_BASE + piece_type - 1])
 
         # Economy
         if not self._economy_phase:
-            output.append(Game.Action(Game.Action.TYPE_ECONOMY, None, None, None))
+            output.append(actions[Game.Action.ECONOMY_ID])
 
         # End Turn
         if self._economy_phase:
-            output.append(Game.Action(Game.Action.TYPE_END_TURN, None, None, None))
+            output.append(actions[Game.Action.END_TURN_ID])
 
         return output
 
-    def _get_piece_actions_at(self, row, col):
+    # Move, Attack and Capture actions for the piece on square, as a tuple
+    def _get_piece_actions_at(self, square):
+        board = self._board
+        player = self._player_to_move
+        actions = Game.Action._TABLE
+        piece = board[_PIECES + square]
+        move_ready = board[_MOVE_READY + square]
+        attack_ready = board[_ATTACK_READY + square]
+
         output = []
         # Capture
-        if (self._cities[row][col] is not None) and (self._cities[row][col] != self._player_to_move):
-            if self._move_ready[row][col] >= 1: # needs to have move readiness
-                if abs(self._pieces[row][col]) != 2 or self._move_ready[row][col] >= 2: # if it's a runner, it needs two move readiness
-                    output.append(Game.Action(Game.Action.TYPE_CAPTURE, (row, col)))
-
-        valid_directions = []
-        if row > 0:
-            if col > 0:
-                valid_directions.append((-1, -1))
-            if col < 7:
-                valid_directions.append((-1, 1))
-            valid_directions.append((-1, 0))
-        if row < 7:
-            if col > 0:
-                valid_directions.append((1, -1))
-            if col < 7:
-                valid_directions.append((1, 1))
-            valid_directions.append((1, 0))
-        if col > 0:
-            valid_directions.append((0, -1))
-        if col < 7:
-            valid_directions.append((0, 1))
-
-        for (row_heading, col_heading) in valid_directions:
-            target_row = row + row_heading
-            target_col = col + col_heading
+        if _IS_CITY[square] and board[_CITIES + square] != player:
+            if move_ready >= 1: # needs to have move readiness
+                if abs(piece) != 2 or move_ready >= 2: # if it's a runner, it needs two move readiness
+                    output.append(actions[Game.Action.CAPTURE_BASE + square])
+
+        move_ids = Game.Action.MOVE_BASE + square * 8
+        attack_ids = Game.Action.ATTACK_BASE + square * 8
+        for heading_index, target, ranged_target in _RAYS[square]:
             # Move
-            if self._move_ready[row][col] > 0 and self._pieces[target_row][target_col] == 0:
-                output.append(Game.Action(Game.Action.TYPE_MOVE, (row, col), (row_heading, col_heading)))
+            if move_ready > 0 and board[_PIECES + target] == 0:
+                output.append(actions[move_ids + heading_index])
 
             # Attack
-            if self._attack_ready[row][col] > 0:
-                if self._pieces[target_row][target_col] * self._player_to_move < 0:
-                    output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+            if attack_ready > 0:
+                if board[_PIECES + target] * player < 0:
+                    output.append(actions[attack_ids + heading_index])
 
                 # Bless is a type of attack
-                elif abs(self._pieces[row][col]) == 6: #support
-                    if self._pieces[target_row][target_col] * self._player_to_move > 0 and self._bless[target_row][target_col] == 0: #if ally at target space
-                        output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+                elif abs(piece) == 6: #support
+                    if board[_PIECES + target] * player > 0 and board[_BLESS + target] == 0: #if ally at target space
+                        output.append(actions[attack_ids + heading_index])
 
-                elif abs(self._pieces[row][col]) == 5: #archer
-                    target_row = row + 2*row_heading
-                    target_col = col + 2*col_heading
-                    if 0 <= target_row <= 7 and 0 <= target_col <= 7:
-                        if self._pieces[target_row][target_col] * self._player_to_move < 0: #if enemy at target space
-                            output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+                elif abs(piece) == 5: #archer
+                    if ranged_target is not None:
+                        if board[_PIECES + ranged_target] * player < 0: #if enemy at target space
+                            output.append(actions[attack_ids + heading_index])
 
-        return output
+        return tuple(output)
 
     # Expects an object of type Action
-    def take_action(self, action):
+    # If record is True, this returns an undo record that can be passed to undo() to get back to the position from
+    # before the action. Records have to be undone in the reverse order they were made in
+    def take_action(self, action, record=False):
         if not isinstance(action, Game.Action):
             raise Exception("Did not pass a proper Action object")
 
+        if record:
+            undo_record = self._make_undo_record(action)
+            self._apply(action)
+            return undo_record
+
+        self._apply(action)
+
+    # Plays a whole turn: a sequence of actions that ends with the one that passes play to the other player (Research
+    # or End Turn), or that wins the game, such as ai_agent.sampleTurn makes. The actions are taken one after another
+    # without checking that they make up a turn, and a rejected action leaves the ones before it played. With
+    # record=True, the board is saved once rather than once per action and returned as a single undo record, and the
+    # turn is all or nothing: a rejected action puts the position back before the exception is raised
+    def apply_turn(self, bundle, record=False):
+        if not record:
+            for action in bundle:
+                self.take_action(action)
+            return
+
+        undo_record = (self._scalars(), _WHOLE_BOARD, (self._board[:], self._piece_actions[:]))
+        try:
+            for action in bundle:
+                self.take_action(action)
+        except Exception:
+            self.undo(undo_record)
+            raise
+        return undo_record
+
+    def _apply(self, action):
+        # The board key is updated by taking out the keys of everything the action can change, and putting back the
+        # keys of what is there afterwards. The phase changing actions only change readiness on the board
+        squares = self._board_squares(action)
+        old_key = 0
+        if squares is None:
+            old_key = self._readiness_key()
+        else:
+            for square in squares:
+                old_key ^= self._square_key(square)
+
         if action.action_type == Game.Action.TYPE_MOVE:
             self._move(action.space, action.heading)
         elif action.action_type == Game.Action.TYPE_ATTACK:
@@ -530,18 +1075,97 @@ class Game:
         else:
             raise Exception("Invalid action type")
 
+        # The phase changing actions reset the whole action cache when they sweep readiness
+        if squares is None:
+            self._board_key ^= old_key ^ self._readiness_key()
+        else:
+            new_key = 0
+            piece_actions = self._piece_actions
+            for square in squares:
+                new_key ^= self._square_key(square)
+                for dependent in _DEPENDENTS[square]:
+                    piece_actions[dependent] = None
+            self._board_key ^= old_key ^ new_key
+
+        self._history = (action, self._history)
+        self._history_length += 1
+
+    # Restores the position from before the action that produced this record
+    def undo(self, undo_record):
+        scalars, squares, saved = undo_record
+        (self._player_to_move, self._economy_phase, self._white_money, self._black_money, self._white_research,
+         self._black_research, self._white_cities, self._black_cities, self._white_pieces, self._black_pieces,
+         self._white_material, self._black_material, self._board_key, self._history, self._history_length,
+         self._search_statistics) = scalars
+        board = self._board
+        if squares is None:
+            board[_READINESS_CELLS] = saved
+            self._piece_actions = [None] * 64
+        elif squares is _WHOLE_BOARD:
+            board[:] = saved[0]
+            self._piece_actions = saved[1][:]
+        else:
+            piece_actions = self._piece_actions
+            for square, cells in zip(squares, saved):
+                board[_SQUARE_CELLS[square]] = cells
+                for dependent in _DEPENDENTS[square]:
+                    piece_actions[dependent] = None
+
+    # An undo record is the scalar state plus a copy of every part of the board the action can change. For board
+    # actions that is every channel of the squares from _board_squares. The phase changing actions can touch readiness
+    # anywhere, so both readiness channels are saved instead
+    def _make_undo_record(self, action):
+        board = self._board
+        scalars = self._scalars()
+
+        squares = self._board_squares(action)
+        if squares is None:
+            return scalars, None, board[_READINESS_CELLS]
+        return scalars, squares, [board[_SQUARE_CELLS[square]] for square in squares]
+
+    # Everything except the board, in the order undo() restores it
+    def _scalars(self):
+        return (self._player_to_move, self._economy_phase, self._white_money, self._black_money, self._white_research,
+                self._black_research, self._white_cities, self._black_cities, self._white_pieces, self._black_pieces,
+                self._white_material, self._black_material, self._board_key, self._history, self._history_length,
+                self._search_statistics)
+
+    # The squares a board action can change: its own square, the adjacent square in the heading and, for Archers, the
+    # one after it. Returns None for the phase changing actions (Research, Economy and End Turn)
+    def _board_squares(self, action):
+        if action._id is not None:
+            return _ACTION_SQUARES[action._id]
+
+        action_type = action.action_type
+        if action_type == Game.Action.TYPE_MOVE or action_type == Game.Action.TYPE_ATTACK:
+            try:
+                row, col = self._parse_space(action.space)
+                vertical_heading, horizontal_heading = self._parse_heading(action.heading)
+            except Exception:
+                # the action will be rejected by take_action without changing anything
+                return ()
+            squares = []
+            for distance in range(3):
+                target_row = row + distance * vertical_heading
+                target_col = col + distance * horizontal_heading
+                if 0 <= target_row <= 7 and 0 <= target_col <= 7:
+                    squares.append(target_row * 8 + target_col)
+            return tuple(squares)
+        elif action_type == Game.Action.TYPE_CAPTURE or action_type == Game.Action.TYPE_PLACE:
+            try:
+                row, col = self._parse_space(action.space)
+            except Exception:
+                return ()
+            return (row * 8 + col,)
+        else:
+            return None
+
     def is_terminal(self):
         return (self.get_reward() != 0)
 
     def get_reward(self):
-        white_cities = False
-        black_cities = False
-        for row in self._cities:
-            for city in row:
-                if city == 1:
-                    white_cities = True
-                if city == -1:
-                    black_cities = True
+        white_cities = self._white_cities > 0
+        black_cities = self._black_cities > 0
 
         if black_cities and not white_cities:
             return -1
@@ -556,12 +1180,12 @@ class Game:
 
         heading = (target_row - row, target_col - col)
 
-        if self._pieces[row][col] * self._player_to_move <= 0:
+        if self._board[_PIECES + row * 8 + col] * self._player_to_move <= 0:
             raise Exception("Source Square Empty")
 
         if row == target_row and col == target_col:
             action = Game.Action(Game.Action.TYPE_CAPTURE, source, None, None)
-        elif self._pieces[target_row][target_col] == 0:
+        elif self._board[_PIECES + target_row * 8 + target_col] == 0:
             action = Game.Action(Game.Action.TYPE_MOVE, source, heading, None)
         else:
             action = Game.Action(Game.Action.TYPE_ATTACK, source, heading, None)
@@ -579,18 +1203,21 @@ class Game:
         if target_row < 0 or target_row > 7 or target_col < 0 or target_col > 7:
             raise Exception("Target space was invalid: " + str(target_row) + " " + str(target_col))
 
-        if self._pieces[target_row][target_col] != 0:
+        square = row * 8 + col
+        target = target_row * 8 + target_col
+
+        if self._board[_PIECES + target] != 0:
             raise Exception("Target space was occupied")
 
-        if self._move_ready[row][col] < 1:
+        if self._board[_MOVE_READY + square] < 1:
             raise Exception("Piece does not have move readiness (already moved this turn)")
 
         # put the piece in its new position
-        self._replace_piece(target_row, target_col, row, col)
+        self._replace_piece(target, square)
         # after the piece is faithfully copied, one point of move readiness is subtracted
-        self._move_ready[target_row][target_col] -= 1
+        self._board[_MOVE_READY + target] -= 1
         # the old tile is now empty
-        self._clear_tile(row, col)
+        self._clear_tile(square)
 
     def _attack(self, space, heading):
         row, col, vertical_heading, horizontal_heading = self._parse_board_action(space, heading)
@@ -601,15 +1228,19 @@ class Game:
         if target_row < 0 or target_row > 7 or target_col < 0 or target_col > 7:
             raise Exception("Target space was invalid: " + str(target_row) + " " + str(target_col))
 
-        if self._attack_ready[row][col] < 1:
+        board = self._board
+        square = row * 8 + col
+        target = target_row * 8 + target_col
+
+        if board[_ATTACK_READY + square] < 1:
             raise Exception("Piece does not have attack readiness (already attacked this turn)")
 
-        attacker_type = abs(self._pieces[row][col])
-        victim_type = abs(self._pieces[target_row][target_col])
+        attacker_type = abs(board[_PIECES + square])
+        victim_type = abs(board[_PIECES + target])
 
         # If the piece and the player_to_move have the same sign, that means a player is trying to attack their own
         # piece. We can check this because their product will be positive,
-        if self._pieces[target_row][target_col] * self._player_to_move >= 0:
+        if board[_PIECES + target] * self._player_to_move >= 0:
             if attacker_type == 5:  # Archer
                 # Archers trying to attack a space with no enemy should check further in that direction
                 self._archer_attack(row, col, vertical_heading, horizontal_heading)
@@ -624,43 +1255,56 @@ class Game:
         attacker_A = self._A_MAP[attacker_type]
         victim_R = self._R_MAP[victim_type]
 
-        if self._bless[target_row][target_col] == 1:  # if victim blessed
-            self._attack_ready[row][col] = 0  # attacker has no more attack (even Berserker as it failed to kill)
-            self._move_ready[row][col] = 0
+        if board[_BLESS + target] == 1:  # if victim blessed
+            board[_ATTACK_READY + square] = 0  # attacker has no more attack (even Berserker as it failed to kill)
+            board[_MOVE_READY + square] = 0
 
-            self._hit(target_row, target_col, attacker_A)  # victim will survive this because it's blessed
-            self._hit(row, col, victim_R + 1)  # victim hits back with +1 to its R
+            self._hit(target, attacker_A)  # victim will survive this because it's blessed
+            self._hit(square, victim_R + 1)  # victim hits back with +1 to its R
         else:
-            self._attack_ready[row][col] = 0  # attacker has no more attack
-            self._move_ready[row][col] = 0
+            board[_ATTACK_READY + square] = 0  # attacker has no more attack
+            board[_MOVE_READY + square] = 0
 
-            kill = self._hit(target_row, target_col, attacker_A)
+            kill = self._hit(target, attacker_A)
 
             if kill:
                 if attacker_type == 7:  # Berserker
-                    self._attack_ready[row][col] = 1
+                    board[_ATTACK_READY + square] = 1
                 if victim_type == 3:  # Defender
-                    self._hit(row, col, 1)
-                self._replace_piece(target_row, target_col, row, col)
-                self._clear_tile(row, col)
+                    self._hit(square, 1)
+                self._replace_piece(target, square)
+                self._clear_tile(square)
             else:
-                self._hit(row, col, victim_R)  # if no kill, victim retaliates
+                self._hit(square, victim_R)  # if no kill, victim retaliates
 
     def _capture(self, space):
         row, col = self._parse_space(space)
 
-        if self._cities[row][col] is None:
+        board = self._board
+        square = row * 8 + col
+
+        if not _IS_CITY[square]:
             raise Exception("Target space does not contain a city")
-        if self._cities[row][col] == self._player_to_move:
+        if board[_CITIES + square] == self._player_to_move:
             raise Exception("Target city is already under your control")
-        if self._pieces[row][col] * self._player_to_move <= 0:
+        if board[_PIECES + square] * self._player_to_move <= 0:
             raise Exception("You do not control a piece in target city")
-        if self._move_ready[row][col] == 0 or (abs(self._pieces[row][col]) == 2 and self._move_ready[row][col] == 1):
+        if board[_MOVE_READY + square] == 0 or (abs(board[_PIECES + square]) == 2 and board[_MOVE_READY + square] == 1):
             raise Exception("A piece that has already moved cannot capture a city until next turn")
 
-        self._cities[row][col] = self._player_to_move
-        self._move_ready[row][col] = 0
-        self._attack_ready[row][col] = 0
+        previous_owner = board[_CITIES + square]
+        if previous_owner == 1:
+            self._white_cities -= 1
+        elif previous_owner == -1:
+            self._black_cities -= 1
+        if self._player_to_move == 1:
+            self._white_cities += 1
+        else:
+            self._black_cities += 1
+
+        board[_CITIES + square] = self._player_to_move
+        board[_MOVE_READY + square] = 0
+        board[_ATTACK_READY + square] = 0
 
     @staticmethod
     def _parse_space(space):
@@ -716,44 +1360,56 @@ class Game:
     def _parse_board_action(self, space, heading):
         row, col = self._parse_space(space)
 
-        if self._pieces[row][col] == 0:
+        piece = self._board[_PIECES + row * 8 + col]
+
+        if piece == 0:
             raise Exception("Space was empty: " + str(row) + " " + str(col))
 
-        if self._pieces[row][col] * self._player_to_move < 0:  # negative times positive makes negative
+        if piece * self._player_to_move < 0:  # negative times positive makes negative
             raise Exception("Piece belongs to the other player: " + str(row) + " " + str(col))
 
         vertical_heading, horizontal_heading = self._parse_heading(heading)
 
         return row, col, vertical_heading, horizontal_heading
 
-    # Faithfully copy the piece from current position to target position
-    def _replace_piece(self, target_row, target_col, row, col):
-        self._pieces[target_row][target_col] = self._pieces[row][col]
-        self._piece_health[target_row][target_col] = self._piece_health[row][col]
-        self._move_ready[target_row][target_col] = self._move_ready[row][col]
-        self._attack_ready[target_row][target_col] = self._attack_ready[row][col]
-        self._bless[target_row][target_col] = self._bless[row][col]
-
-    # Removes a piece from position
-    def _clear_tile(self, row, col):
-        self._pieces[row][col] = 0
-        self._piece_health[row][col] = 0
-        self._move_ready[row][col] = 0
-        self._attack_ready[row][col] = 0
-        self._bless[row][col] = 0
+    # Faithfully copy the piece from current square to target square
+    def _replace_piece(self, target, square):
+        board = self._board
+        board[_PIECES + target] = board[_PIECES + square]
+        board[_HEALTH + target] = board[_HEALTH + square]
+        board[_MOVE_READY + target] = board[_MOVE_READY + square]
+        board[_ATTACK_READY + target] = board[_ATTACK_READY + square]
+        board[_BLESS + target] = board[_BLESS + square]
+
+    # Removes a piece from a square
+    def _clear_tile(self, square):
+        board = self._board
+        board[_PIECES + square] = 0
+        board[_HEALTH + square] = 0
+        board[_MOVE_READY + square] = 0
+        board[_ATTACK_READY + square] = 0
+        board[_BLESS + square] = 0
 
     # Deals damage to a piece, and removes it if it dies. Returns a boolean telling you whether it died
-    def _hit(self, row, col, damage):
-        if self._bless[row][col] == 1:  # if blessed, it lives and stops being blessed
-            self._bless[row][col] = 0
+    def _hit(self, square, damage):
+        board = self._board
+        if board[_BLESS + square] == 1:  # if blessed, it lives and stops being blessed
+            board[_BLESS + square] = 0
             return False
 
         # otherwise, it takes damage
-        self._piece_health[row][col] -= damage
+        board[_HEALTH + square] -= damage
 
-        if self._piece_health[row][col] <= 0:
+        if board[_HEALTH + square] <= 0:
             # if it's reduced to 0 or less, remove it from the board and indicate that it died
-            self._clear_tile(row, col)
+            piece = board[_PIECES + square]
+            if piece > 0:
+                self._white_pieces -= 1
+                self._white_material -= self._C_MAP[piece]
+            else:
+                self._black_pieces -= 1
+                self._black_material -= self._C_MAP[-piece]
+            self._clear_tile(square)
             return True
         else:
             # otherwise, indicate that it didn't die
@@ -767,12 +1423,16 @@ class Game:
         if target_row < 0 or target_row > 7 or target_col < 0 or target_col > 7:
             raise Exception("Target space was invalid: " + str(target_row) + " " + str(target_col))
 
-        if self._pieces[target_row][target_col] * self._player_to_move >= 0:
+        board = self._board
+        square = row * 8 + col
+        target = target_row * 8 + target_col
+
+        if board[_PIECES + target] * self._player_to_move >= 0:
             raise Exception("Target space does not contain an enemy")
 
-        self._hit(target_row, target_col, self._A_MAP[5])
-        self._attack_ready[row][col] = 0
-        self._move_ready[row][col] = 0
+        self._hit(target, self._A_MAP[5])
+        board[_ATTACK_READY + square] = 0
+        board[_MOVE_READY + square] = 0
 
     def _support_attack(self, row, col, vertical_heading, horizontal_heading):
         target_row = row + vertical_heading
@@ -782,15 +1442,19 @@ class Game:
         # if target_row < 0 or target_row > 7 or target_col < 0 or target_col > 7:
         #     raise Exception("Target space was invalid: " + str(target_row) + " " + str(target_col))
 
-        if self._pieces[target_row][target_col] * self._player_to_move <= 0:
+        board = self._board
+        square = row * 8 + col
+        target = target_row * 8 + target_col
+
+        if board[_PIECES + target] * self._player_to_move <= 0:
             raise Exception("Target space does not contain an ally")
 
-        if self._bless[target_row][target_col] == 1:
+        if board[_BLESS + target] == 1:
             raise Exception("Target is already blessed")
 
-        self._bless[target_row][target_col] = 1
-        self._attack_ready[row][col] = 0
-        self._move_ready[row][col] = 0
+        board[_BLESS + target] = 1
+        board[_ATTACK_READY + square] = 0
+        board[_MOVE_READY + square] = 0
 
     def _research(self, piece_type):
         if self._economy_phase:
@@ -799,14 +1463,18 @@ class Game:
         if isinstance(piece_type, str):
             piece_type = self._NAME_TO_NUMBER[piece_type]
 
+        # Only bits 1 to 7 of the research masks are piece types, and the Zobrist tables only cover those
+        if type(piece_type) is not int or not 1 <= piece_type <= 7:
+            raise Exception("Invalid piece type to research")
+
         if self._player_to_move == 1:
-            if self._white_research[piece_type]:
+            if self._white_research >> piece_type & 1:
                 raise Exception("Unit type already researched")
-            self._white_research[piece_type] = True
+            self._white_research |= 1 << piece_type
         else:
-            if self._black_research[piece_type]:
+            if self._black_research >> piece_type & 1:
                 raise Exception("Unit type already researched")
-            self._black_research[piece_type] = True
+            self._black_research |= 1 << piece_type
 
         self._unready()
         self._end_turn()
@@ -818,17 +1486,10 @@ class Game:
         self._economy_phase = True
         self._unready()
 
-        income = 0
-
-        for row in range(8):
-            for col in range(8):
-                if self._cities[row][col] == self._player_to_move:
-                    income += 1
-
         if self._player_to_move == 1:
-            self._white_money += income
+            self._white_money += self._white_cities
         else:
-            self._black_money += income
+            self._black_money += self._black_cities
 
     def _place(self, space, piece_type):
         if not self._economy_phase:
@@ -836,10 +1497,13 @@ class Game:
 
         row, col = self._parse_space(space)
 
-        if self._cities[row][col] != self._player_to_move:
+        board = self._board
+        square = row * 8 + col
+
+        if not _IS_CITY[square] or board[_CITIES + square] != self._player_to_move:
             raise Exception("Trying to place a piece in at a location that is not one of your cities")
 
-        if self._pieces[row][col] != 0:
+        if board[_PIECES + square] != 0:
             raise Exception("Trying to place a piece in an occupied city")
 
         if isinstance(piece_type, str):
@@ -852,7 +1516,7 @@ class Game:
             research = self._black_research
             money = self._black_money
 
-        if not research[piece_type]:
+        if not research >> piece_type & 1:
             raise Exception("Trying to place a piece you haven't researched")
 
         cost = self._C_MAP[piece_type]
@@ -861,11 +1525,15 @@ class Game:
 
         if self._player_to_move == 1:
             self._white_money -= cost
+            self._white_pieces += 1
+            self._white_material += cost
         else:
             self._black_money -= cost
+            self._black_pieces += 1
+            self._black_material += cost
 
-        self._pieces[row][col] = self._player_to_move * piece_type
-        self._piece_health[row][col] = self._M_MAP[piece_type]
+        board[_PIECES + square] = self._player_to_move * piece_type
+        board[_HEALTH + square] = self._M_MAP[piece_type]
 
     def _end_turn(self):
         self._player_to_move *= -1
@@ -873,17 +1541,119 @@ class Game:
         self._ready()
 
     def _unready(self):
-        for row in range(8):
-            for col in range(8):
-                self._move_ready[row][col] = 0
-                self._attack_ready[row][col] = 0
+        # the move and attack readiness channels are next to each other, so this clears both in one go
+        self._board[_READINESS_CELLS] = _NO_READINESS
+        self._piece_actions = [None] * 64
 
     def _ready(self):
-        for row in range(8):
-            for col in range(8):
-                if self._pieces[row][col] * self._player_to_move > 0:
-                    if abs(self._pieces[row][col]) == 2:  # Runner
-                        self._move_ready[row][col] = 2
-                    else:
-                        self._move_ready[row][col] = 1
-                    self._attack_ready[row][col] = 1
+        board = self._board
+        player = self._player_to_move
+        for square in range(64):
+            piece = board[_PIECES + square]
+            if piece * player > 0:
+                if piece == 2 or piece == -2:  # Runner
+                    board[_MOVE_READY + square] = 2
+                else:
+                    board[_MOVE_READY + square] = 1
+                board[_ATTACK_READY + square] = 1
+        self._piece_actions = [None] * 64
+
+
+# One shared Action per id, in id order, so move generation never has to allocate actions
+def _build_action_table():
+    Action = Game.Action
+    table = []
+    for action_type in (Action.TYPE_MOVE, Action.TYPE_ATTACK):
+        for square in range(64):
+            for heading in Action.HEADINGS:
+                table.append(Action(action_type, (square // 8, square % 8), heading))
+    for square in range(64):
+        table.append(Action(Action.TYPE_CAPTURE, (square // 8, square % 8)))
+    for piece_type in range(1, 8):
+        table.append(Action(Action.TYPE_RESEARCH, None, None, piece_type))
+    table.append(Action(Action.TYPE_ECONOMY))
+    for square in range(64):
+        for piece_type in range(1, 8):
+            table.append(Action(Action.TYPE_PLACE, (square // 8, square % 8), None, piece_type))
+    table.append(Action(Action.TYPE_END_TURN))
+
+    assert all(action.to_id() == action_id for action_id, action in enumerate(table))
+    return tuple(table)
+
+
+Game.Action._TABLE = _build_action_table()
+
+
+# The id of each action's mirror image (see Game.Action.mirror)
+def _build_mirror_ids():
+    Action = Game.Action
+    mirror_ids = []
+    for action in Action._TABLE:
+        if action.space is None:
+            mirror_ids.append(action.to_id())
+            continue
+        row, col = action.space
+        space = (7 - row, 7 - col)
+        heading = None
+        if action.heading is not None:
+            heading = Action.HEADINGS[(Action.HEADING_INDEX[action.heading] + 4) % 8]
+        mirror_ids.append(Action(action.action_type, space, heading, action.piece_type).to_id())
+    return tuple(mirror_ids)
+
+
+_MIRROR_IDS = _build_mirror_ids()
+
+
+# For each square, the directions a piece there can face as (heading index, adjacent square, the square two steps away
+# or None if that is off the board). They are listed in the order their actions have always been generated in
+def _build_rays():
+    directions = ((-1, -1), (-1, 1), (-1, 0), (1, -1), (1, 1), (1, 0), (0, -1), (0, 1))
+    rays = []
+    for square in range(64):
+        row, col = square // 8, square % 8
+        square_rays = []
+        for row_heading, col_heading in directions:
+            if not (0 <= row + row_heading <= 7 and 0 <= col + col_heading <= 7):
+                continue
+            target = square + row_heading * 8 + col_heading
+            ranged_target = None
+            if 0 <= row + 2 * row_heading <= 7 and 0 <= col + 2 * col_heading <= 7:
+                ranged_target = square + 2 * (row_heading * 8 + col_heading)
+            square_rays.append((Game.Action.HEADING_INDEX[(row_heading, col_heading)], target, ranged_target))
+        rays.append(tuple(square_rays))
+    return tuple(rays)
+
+
+_RAYS = _build_rays()
+
+# The squares whose piece actions depend on a square: itself, its neighbours, and the squares two steps away in a
+# straight line (an Archer there can shoot past the neighbour)
+_DEPENDENTS = tuple(
+    tuple(sorted({square} | {target for _, target, _ in _RAYS[square]} |
+                 {ranged_target for _, _, ranged_target in _RAYS[square] if ranged_target is not None}))
+    for square in range(64)
+)
+
+
+# The squares each action can change (see Game._board_squares), indexed by action id
+def _build_action_squares():
+    Action = Game.Action
+    action_squares = []
+    for action in Action._TABLE:
+        if action.action_type in (Action.TYPE_MOVE, Action.TYPE_ATTACK):
+            row, col = action.space
+            row_heading, col_heading = action.heading
+            squares = []
+            for distance in range(3):
+                if 0 <= row + distance * row_heading <= 7 and 0 <= col + distance * col_heading <= 7:
+                    squares.append((row + distance * row_heading) * 8 + col + distance * col_heading)
+            action_squares.append(tuple(squares))
+        elif action.action_type in (Action.TYPE_CAPTURE, Action.TYPE_PLACE):
+            row, col = action.space
+            action_squares.append((row * 8 + col,))
+        else:
+            action_squares.append(None)
+    return tuple(action_squares)
+
+
+_ACTION_SQUARES = _build_action_squares()
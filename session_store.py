@@ -0,0 +1,226 @@
+import secrets
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from game import Game
+
+
+# One player's game, with everything the web server keeps alongside it
+class Session:
+    def __init__(self, user, game, agent, channel):
+        self.user = user
+        self.game = game
+        self.agent = agent
+        # held while the game is read or changed, but not while the AI thinks
+        self.lock = threading.Lock()
+        self.channel = channel
+        # whether an AI turn is waiting to be played or in progress
+        self.thinking = False
+        # the AI turn in progress or last finished, when it is played in this process
+        self.ai_turn = None
+        # how many times the game has been saved, to tell whether the database has changes this process hasn't seen
+        self.revision = 0
+        # how long a claim() by this process lasts, renewed whenever the game is saved
+        self.lease = None
+        self.last_used = time.monotonic()
+
+    def is_thinking(self):
+        return self.thinking
+
+
+# Sessions by user id. Every game is saved to an SQLite database as the ids of the actions played, so only recently
+# used sessions need to be in memory: at most max_sessions are kept, and any left idle for ttl seconds are dropped. A
+# session that was dropped, or every session after a restart, is rebuilt by replaying its actions the next time its
+# user asks for it. Sessions in the middle of something (this process is playing an AI turn, a request holds the
+# game's lock, or a client is subscribed to its events) are never dropped
+#
+# With shared set, several processes use the same database at once, e.g. web server workers and ai_worker.py
+# processes. The database is then the only copy of record: every access catches the session up with its row, and
+# every change is made in a transaction that holds the database's write lock, so two processes never change a game at
+# once. AI turns are left in the database for claim() instead of being played by the web server
+class SessionStore:
+    def __init__(self, path, new_agent, new_channel, max_sessions=1000, ttl=30 * 60, shared=False, resume=None):
+        self.new_agent = new_agent
+        self.new_channel = new_channel
+        # unless shared, called with each session that is loaded in the middle of an AI turn, to start it again
+        self.resume = resume
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.shared = shared
+        self.sessions = OrderedDict()
+        # guards sessions, and the AI turn of every session
+        self.lock = threading.Lock()
+        # transactions are started by hand, so that changes can take the write lock before reading the game
+        self.database = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.database_lock = threading.Lock()
+        with self.database_lock:
+            self.database.execute("PRAGMA journal_mode=WAL")
+            # several processes can start at once, so the table is set up in a transaction
+            self.database.execute("BEGIN IMMEDIATE")
+            try:
+                self.database.execute("CREATE TABLE IF NOT EXISTS games (user TEXT PRIMARY KEY, actions BLOB NOT NULL, "
+                                      "updated REAL NOT NULL, revision NOT NULL DEFAULT 0, thinking NOT NULL DEFAULT 0, "
+                                      "claimed_until NOT NULL DEFAULT 0)")
+                # databases from before games were shared lack the last three columns
+                columns = [row[1] for row in self.database.execute("PRAGMA table_info(games)")]
+                for column in ("revision", "thinking", "claimed_until"):
+                    if column not in columns:
+                        self.database.execute("ALTER TABLE games ADD COLUMN %s NOT NULL DEFAULT 0" % column)
+                self.database.execute("COMMIT")
+            except BaseException:
+                self.database.execute("ROLLBACK")
+                raise
+
+    # The session of user, loading it from the database if it isn't in memory. None if there is no such user
+    def get(self, user):
+        with self.lock:
+            session = self.sessions.get(user)
+            loaded = session is None
+            if loaded:
+                row = self._load(user)
+                if row is None:
+                    return None
+                game = Game()
+                session = Session(user, game, self.new_agent(), None)
+                session.revision = -1
+                self._catch_up(session, row)
+                # the channel starts from the game as loaded, which may be in the middle of an AI turn
+                session.channel = self.new_channel(game, session.thinking)
+                self.sessions[user] = session
+            self.sessions.move_to_end(user)
+            session.last_used = time.monotonic()
+            self._evict()
+        if self.shared and not loaded:
+            self.refresh(session)
+        if loaded and not self.shared and session.thinking and self.resume is not None:
+            self.resume(session)
+        return session
+
+    # A new session with a new game, under a user id nobody can guess
+    def create(self):
+        with self.lock:
+            user = secrets.token_urlsafe(16)
+            game = Game()
+            session = Session(user, game, self.new_agent(), self.new_channel(game))
+            self.sessions[user] = session
+            with self.database_lock:
+                self._save(session)
+            self._evict()
+            return session
+
+    # Catches the session up with changes other processes made to its game. Only does anything when shared
+    def refresh(self, session):
+        if not self.shared:
+            return session
+        row = self._load(session.user)
+        with session.lock:
+            self._catch_up(session, row)
+        return session
+
+    # Holds the session's lock while the game is changed, then saves it. When shared, the change is one transaction:
+    # the game is caught up with the database first, and no other process can change it until the change is saved
+    @contextmanager
+    def change(self, session):
+        with session.lock:
+            if not self.shared:
+                yield session
+                with self.database_lock:
+                    self._save(session)
+                return
+            with self.database_lock:
+                self.database.execute("BEGIN IMMEDIATE")
+                try:
+                    self._catch_up(session, self._select(session.user))
+                    yield session
+                    self._save(session)
+                    self.database.execute("COMMIT")
+                except BaseException:
+                    self.database.execute("ROLLBACK")
+                    raise
+
+    # For ai_worker.py: the session of a game waiting for an AI turn that no other process is playing, which is then
+    # held by this process for lease seconds. None if there are none
+    def claim(self, lease=60):
+        with self.database_lock:
+            self.database.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.database.execute("SELECT user FROM games WHERE thinking = 1 AND claimed_until < ? "
+                                            "ORDER BY updated LIMIT 1", (time.time(),)).fetchone()
+                if row is not None:
+                    self.database.execute("UPDATE games SET claimed_until = ? WHERE user = ?",
+                                          (time.time() + lease, row[0]))
+                self.database.execute("COMMIT")
+            except BaseException:
+                self.database.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        session = self.get(row[0])
+        session.lease = lease
+        return session
+
+    # Called with the database lock held. A claimed game's lease is renewed every time it is saved, and ends with the
+    # AI turn
+    def _save(self, session):
+        actions = array("H", (action.to_id() for action in session.game.get_history())).tobytes()
+        session.revision += 1
+        now = time.time()
+        self.database.execute("INSERT INTO games (user, actions, updated, revision, thinking) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT (user) DO UPDATE SET actions = excluded.actions, updated = excluded.updated, "
+                              "revision = excluded.revision, thinking = excluded.thinking, "
+                              "claimed_until = CASE WHEN excluded.thinking THEN MAX(claimed_until, ?) ELSE 0 END",
+                              (session.user, actions, now, session.revision, session.thinking,
+                               now + session.lease if session.lease else 0))
+
+    def _select(self, user):
+        return self.database.execute("SELECT actions, revision, thinking FROM games WHERE user = ?",
+                                     (user,)).fetchone()
+
+    def _load(self, user):
+        with self.database_lock:
+            return self._select(user)
+
+    # Brings the session up to a row of the database, unless the session is already as new. Games only ever have
+    # actions added, so the row's extra actions are taken on the game in memory, and published to its channel. Called
+    # with the session's lock held
+    def _catch_up(self, session, row):
+        if row is None or row[1] <= session.revision:
+            return
+        actions = array("H")
+        actions.frombytes(row[0])
+        game = session.game
+        thinking = bool(row[2])
+        for action_id in actions[game.history:]:
+            action = Game.Action.from_id(action_id)
+            game.take_action(action)
+            if session.channel is not None:
+                session.channel.publish(game, thinking, action)
+        if not self.shared:
+            # only happens when the session is loaded. An AI turn that was under way when the session was dropped, or
+            # the process stopped, is played again by resume
+            thinking = game.get_player_to_move() == -1 and not game.is_terminal()
+        session.revision = row[1]
+        session.thinking = thinking
+        if session.channel is not None:
+            session.channel.publish(game, session.is_thinking())
+
+    # Drops the least recently used sessions past max_sessions and the ones idle for longer than ttl. They are already
+    # saved, so this only forgets them, along with their agent's search tree
+    def _evict(self):
+        expired = time.monotonic() - self.ttl
+        for user, session in list(self.sessions.items()):
+            if len(self.sessions) <= self.max_sessions and session.last_used > expired:
+                break
+            playing = session.ai_turn is not None and not session.ai_turn.done()
+            if playing or session.channel.subscribers > 0 or not session.lock.acquire(blocking=False):
+                continue
+            del self.sessions[user]
+            session.lock.release()
+            session.agent.forget()
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,5 +1,6 @@
 window.game = {
     state: null,
+    rules: null,
     selected: null,
     player: "white",
     other_player: "black",
@@ -57,6 +58,7 @@ window.game = {
                             window.game.state = data;
                             
                             window.game.render();
+                            window.game.wait_for_ai();
                         }).catch((err) => {
                             console.log(err);
                         });
@@ -77,7 +79,7 @@ window.game = {
     },
     initialize: function(){
         return new Promise((resolve, reject) => {
-            window.game.refresh().then(() => {
+            Promise.all([window.game.refresh(), window.game.load_rules()]).then(() => {
                 var view_port = document.getElementById("game");
 
                 var panel_titles = [
@@ -320,18 +322,18 @@ window.game = {
                             }
                         }
 
-                        health.innerHTML += window.game.state.piece_health[i][j] + "/" + window.game.state.max_health[Math.abs(piece).toString()];
+                        health.innerHTML += window.game.state.piece_health[i][j] + "/" + window.game.rules.max_health[Math.abs(piece).toString()];
 
                         health.classList.add("health");
 
                     var attack = document.createElement("p");
 
-                        attack.innerHTML = window.game.state.attack[Math.abs(piece).toString()];
+                        attack.innerHTML = window.game.rules.attack[Math.abs(piece).toString()];
 
                         attack.classList.add("attack");
 
                     var retaliation = document.createElement("p");
-                        retaliation.innerHTML = window.game.state.retaliation[Math.abs(piece).toString()];
+                        retaliation.innerHTML = window.game.rules.retaliation[Math.abs(piece).toString()];
 
                         retaliation.classList.add("retaliation");
 
@@ -432,6 +434,64 @@ window.game = {
             });
         });
     },
+    subscribe: function(){
+        if(!window.EventSource){
+            window.game.wait_for_ai();
+            return;
+        }
+
+        window.game.source = new EventSource("/game/events");
+        window.game.source.onmessage = function(event){
+            var data = JSON.parse(event.data);
+
+            if(data.state){
+                window.game.state = data.state;
+            }else{
+                Object.assign(window.game.state, data.delta);
+            }
+
+            window.game.render();
+        };
+    },
+    wait_for_ai: function(){
+        if(window.game.source || !window.game.state.thinking){
+            return;
+        }
+
+        fetch("/game/status?wait=20&since=" + window.game.state.version).then((response) => response.json()).then((data) => {
+            window.game.apply_changes(data);
+            window.game.render();
+            window.game.wait_for_ai();
+        }).catch((err) => {
+            console.log(err);
+        });
+    },
+    apply_changes: function(data){
+        if(!data.cells){
+            window.game.state = data;
+            return;
+        }
+
+        for(var field in data.cells){
+            for(var k = 0; k < data.cells[field].length; k++){
+                var cell = data.cells[field][k];
+                window.game.state[field][cell[0]][cell[1]] = cell[2];
+            }
+        }
+
+        Object.assign(window.game.state, data.delta);
+        window.game.state.version = data.version;
+    },
+    load_rules: function(){
+        return new Promise((resolve, reject) => {
+            fetch("/game/rules").then((response) => response.json()).then((data) => {
+                window.game.rules = data;
+                resolve();
+            }).catch((err) => {
+                reject(err);
+            });
+        });
+    },
     refresh: function(){
         return new Promise((resolve, reject) => {
             fetch("/game/status").then((response) => response.json()).then((data) => {
@@ -0,0 +1,44 @@
+import numpy
+import pytest
+
+pytest.importorskip("tensorflow")
+
+import ai
+from game import Game
+
+
+# Knows nothing: every position is even and every action equally likely, so only the search can find the winning move
+class UniformNetwork:
+    def evaluate(self, game):
+        return 0.5, numpy.zeros(Game.Action.NUM_IDS)
+
+
+def _walk(game, white_headings, black_headings):
+    for white_heading, black_heading in zip(white_headings, black_headings):
+        for heading, player in ((white_heading, 1), (black_heading, -1)):
+            space = next((row, col) for row, pieces in enumerate(game.get_pieces())
+                         for col, piece in enumerate(pieces) if piece == player)
+            game.take_action(Game.Action(Game.Action.TYPE_MOVE, space, heading))
+            game.take_action(Game.Action(Game.Action.TYPE_ECONOMY))
+            game.take_action(Game.Action(Game.Action.TYPE_END_TURN))
+
+
+# White's Basic walks round to Black's only city while Black's walks round to White's. With White to move, capturing
+# wins on the spot, and anything that hands the turn to Black lets Black capture White's city and win instead
+def test_search_finds_the_winning_capture():
+    game = Game()
+    _walk(game, [(0, -1)] * 7 + [(-1, 0)] * 7, [(0, 1)] * 7 + [(1, 0)] * 7)
+    capture = Game.Action(Game.Action.TYPE_CAPTURE, (0, 0))
+    assert game.get_player_to_move() == 1 and capture in game.get_possible_actions()
+
+    config = ai.AlphaZeroConfig()
+    config.num_simulations = 400
+    config.num_sampling_moves = 0
+    numpy.random.seed(0)
+    action, root = ai.run_mcts(config, game, UniformNetwork())
+    assert action == capture
+
+    # from White's side, every action that passes the turn to Black loses
+    for index, child_action in enumerate(root.actions):
+        if child_action.action_type == Game.Action.TYPE_RESEARCH and root.child_visits[index] > 0:
+            assert root.child_value_sums[index] / root.child_visits[index] < 0.5
@@ -0,0 +1,137 @@
+import random
+
+from game import Game
+
+
+# get_possible_actions and _get_piece_actions_at copied verbatim from the Game before its state became one flat board
+# buffer, as the reference the move generator is checked against. Only __init__ is new: it reads a Game's state
+# through its getters into the nested lists the old code used
+class BaselineGame:
+    _C_MAP = Game._C_MAP
+
+    def __init__(self, game):
+        self._player_to_move = game.get_player_to_move()
+        self._economy_phase = game.get_economy_phase()
+        self._white_money = game.get_white_money()
+        self._black_money = game.get_black_money()
+        self._white_research = game.get_white_research()
+        self._black_research = game.get_black_research()
+        self._cities = game.get_cities()
+        self._pieces = game.get_pieces()
+        self._move_ready = game.get_move_ready()
+        self._attack_ready = game.get_attack_ready()
+        self._bless = game.get_bless()
+
+    # Returns a list of objects of type Action
+    def get_possible_actions(self):
+        if self._player_to_move == 1:
+            money = self._white_money
+        else:
+            money = self._black_money
+
+        if self._player_to_move == 1:
+            tech = self._white_research
+        else:
+            tech = self._black_research
+
+        output = []
+        for row in range(8):
+            for col in range(8):
+                if self._pieces[row][col] * self._player_to_move > 0:
+                    output.extend(self._get_piece_actions_at(row, col))  # Move, Attack, Capture
+
+        # Place
+        if self._economy_phase:
+            for row in range(8):
+                for col in range(8):
+                    if self._cities[row][col] == self._player_to_move and self._pieces[row][col] == 0:
+                        # in each empty city the current player owns
+                        for piece_type in range(1, 8):
+                            # for each kind of piece
+                            if tech[piece_type] and money > self._C_MAP[piece_type]:
+                                output.append(Game.Action(Game.Action.TYPE_PLACE, (row, col), None, piece_type))
+
+        # Research
+        if not self._economy_phase:
+            for piece_type in range(1, 8):
+                if not tech[piece_type]:
+                    output.append(Game.Action(Game.Action.TYPE_RESEARCH, None, None, piece_type))
+
+        # Economy
+        if not self._economy_phase:
+            output.append(Game.Action(Game.Action.TYPE_ECONOMY, None, None, None))
+
+        # End Turn
+        if self._economy_phase:
+            output.append(Game.Action(Game.Action.TYPE_END_TURN, None, None, None))
+
+        return output
+
+    def _get_piece_actions_at(self, row, col):
+        output = []
+        # Capture
+        if (self._cities[row][col] is not None) and (self._cities[row][col] != self._player_to_move):
+            if self._move_ready[row][col] >= 1: # needs to have move readiness
+                if abs(self._pieces[row][col]) != 2 or self._move_ready[row][col] >= 2: # if it's a runner, it needs two move readiness
+                    output.append(Game.Action(Game.Action.TYPE_CAPTURE, (row, col)))
+
+        valid_directions = []
+        if row > 0:
+            if col > 0:
+                valid_directions.append((-1, -1))
+            if col < 7:
+                valid_directions.append((-1, 1))
+            valid_directions.append((-1, 0))
+        if row < 7:
+            if col > 0:
+                valid_directions.append((1, -1))
+            if col < 7:
+                valid_directions.append((1, 1))
+            valid_directions.append((1, 0))
+        if col > 0:
+            valid_directions.append((0, -1))
+        if col < 7:
+            valid_directions.append((0, 1))
+
+        for (row_heading, col_heading) in valid_directions:
+            target_row = row + row_heading
+            target_col = col + col_heading
+            # Move
+            if self._move_ready[row][col] > 0 and self._pieces[target_row][target_col] == 0:
+                output.append(Game.Action(Game.Action.TYPE_MOVE, (row, col), (row_heading, col_heading)))
+
+            # Attack
+            if self._attack_ready[row][col] > 0:
+                if self._pieces[target_row][target_col] * self._player_to_move < 0:
+                    output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+
+                # Bless is a type of attack
+                elif abs(self._pieces[row][col]) == 6: #support
+                    if self._pieces[target_row][target_col] * self._player_to_move > 0 and self._bless[target_row][target_col] == 0: #if ally at target space
+                        output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+
+                elif abs(self._pieces[row][col]) == 5: #archer
+                    target_row = row + 2*row_heading
+                    target_col = col + 2*col_heading
+                    if 0 <= target_row <= 7 and 0 <= target_col <= 7:
+                        if self._pieces[target_row][target_col] * self._player_to_move < 0: #if enemy at target space
+                            output.append(Game.Action(Game.Action.TYPE_ATTACK, (row, col), (row_heading, col_heading)))
+
+        return output
+
+
+def _action_ids(actions):
+    return sorted(action.to_id() for action in actions)
+
+
+# Plays random games, and after every action checks both the cached and the uncached move generator against the
+# baseline one. The order of the actions may differ, but not which actions there are
+def test_possible_actions_match_baseline():
+    rng = random.Random(0)
+    for _ in range(6):
+        game = Game()
+        while not game.is_terminal():
+            expected = _action_ids(BaselineGame(game).get_possible_actions())
+            assert _action_ids(game.get_possible_actions()) == expected
+            assert _action_ids(game._get_possible_actions_uncached()) == expected
+            game.take_action(rng.choice(game.get_possible_actions()))
@@ -39,26 +39,31 @@ class TypingHumanAgent(Agent):
                 print("Try again (or type \"help\")")
                 continue
 
-            action = Game.Action(action_type)
+            # Actions are immutable, so collect the parameters first
+            space = None
+            heading = None
+            piece_type = None
 
             match action_type:
                 case Game.Action.TYPE_MOVE:
-                    action.space = action_decomposition[1]
-                    action.heading = action_decomposition[2]
+                    space = action_decomposition[1]
+                    heading = action_decomposition[2]
                 case Game.Action.TYPE_ATTACK:
-                    action.space = action_decomposition[1]
-                    action.heading = action_decomposition[2]
+                    space = action_decomposition[1]
+                    heading = action_decomposition[2]
                 case Game.Action.TYPE_CAPTURE:
-                    action.space = action_decomposition[1]
+                    space = action_decomposition[1]
                 case Game.Action.TYPE_RESEARCH:
-                    action.piece_type = int(action_decomposition[1])
+                    piece_type = int(action_decomposition[1])
                 case Game.Action.TYPE_ECONOMY:
                     pass
                 case Game.Action.TYPE_PLACE:
-                    action.space = action_decomposition[1]
-                    action.piece_type = int(action_decomposition[2])
+                    space = action_decomposition[1]
+                    piece_type = int(action_decomposition[2])
                 case Game.Action.TYPE_END_TURN:
                     pass
+
+            action = Game.Action(action_type, space, heading, piece_type)
             print("Accepted")
             return action
 